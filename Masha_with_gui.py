@@ -18,6 +18,7 @@ import random
 import signal
 import traceback # For error_handler
 import html # For error_handler
+import threading
 
 # Telegram imports
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Voice, InputFile, User, VideoNote, constants
@@ -38,6 +39,7 @@ import google.generativeai as genai
 import speech_recognition as sr
 from pydub import AudioSegment
 from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
+import numpy as np
 
 # GUI imports
 import tkinter as tk
@@ -68,6 +70,7 @@ MAX_HISTORY: int = _initial_settings.MAX_HISTORY
 DEFAULT_STYLE: str = _initial_settings.DEFAULT_STYLE
 BOT_NAME: str = _initial_settings.BOT_NAME
 HISTORY_TTL: int = _initial_settings.HISTORY_TTL
+RELATIONSHIP_DECAY_HALF_LIFE: float = float(os.getenv('RELATIONSHIP_DECAY_HALF_LIFE', str(7 * 86400))) # Seconds for scores to move halfway back to neutral
 TOKEN: Optional[str] = os.getenv('TELEGRAM_BOT_TOKEN')
 API_KEY: Optional[str] = os.getenv('GEMINI_API_KEY')
 ADMIN_USER_IDS: List[int] = list(map(int, os.getenv('ADMIN_IDS', '').split(','))) if os.getenv('ADMIN_IDS') else []
@@ -85,7 +88,7 @@ FAREWELLS = ["Пока!", "До встречи!", "Удачи!", "Хорошег
 user_preferred_name: Dict[int, str] = {}
 user_topic: Dict[int, str] = {} # Topic per chat/user history key
 learned_responses: Dict[str, str] = {} # Simple question-answer learning
-user_info_db: Dict[int, Dict[str, Any]] = {} # Stores user preferences, relationships, etc.
+user_info_db: Dict[int, Dict[str, Any]] = {} # Stores user preferences, chats, memories (relationships live in RelationshipStore)
 group_preferences: Dict[int, Dict[str, str]] = {} # Group-specific settings (not heavily used yet)
 chat_history: Dict[int, Deque[str]] = {} # Stores conversation history (key is chat_id or user_id)
 last_activity: Dict[int, float] = {} # Timestamp of last activity for history cleanup
@@ -94,6 +97,7 @@ group_user_style_prompts: Dict[Tuple[int, int], str] = {} # Specific styles for
 # --- File Paths ---
 KNOWLEDGE_FILE = "learned_knowledge.json" # For learned responses, preferred names, styles
 USER_DATA_DIR = "user_data" # Directory for individual user data files
+RELATIONSHIPS_FILE = "relationships.npz" # Relationship scores of all users in one table
 LOG_FILENAME = "bot.log" # Main log file name
 
 # --- Logging Setup ---
@@ -153,17 +157,148 @@ User's message: "{current_message}"
 Answer ONLY "Yes" or "No".
 """
 
-# --- Relationship Class ---
+# --- Relationship Store ---
+RELATIONSHIP_FIELDS = ("infatuation", "love", "liking", "neutral", "disliking", "hatred", "trolling", "trust")
+POSITIVE_COLUMNS = [RELATIONSHIP_FIELDS.index(name) for name in ("infatuation", "love", "liking")]
+NEGATIVE_COLUMNS = [RELATIONSHIP_FIELDS.index(name) for name in ("disliking", "hatred", "trolling")]
+NEUTRAL_COLUMN = RELATIONSHIP_FIELDS.index("neutral")
+
+class RelationshipStore:
+    """Relationship scores of all users in one NumPy table: a row per user, a column per emotion.
+
+    Rows are never removed (resetting a user just restores the defaults), so a row index stays valid
+    for the lifetime of the store. Decay and persistence work on the whole table at once.
+    """
+    DEFAULTS = np.array([0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 0.0])
+
+    def __init__(self, initial_capacity: int = 64):
+        self._lock = threading.Lock() # Guards table growth and snapshots taken from the save thread
+        self._values = np.tile(self.DEFAULTS, (initial_capacity, 1))
+        self._user_ids: List[int] = []
+        self._rows: Dict[int, int] = {}
+        self.decayed_at = time.time()
+
+    def __contains__(self, user_id: int) -> bool:
+        return user_id in self._rows
+
+    def __len__(self) -> int:
+        return len(self._user_ids)
+
+    def _row(self, user_id: int) -> int:
+        row = self._rows.get(user_id)
+        if row is None:
+            with self._lock:
+                row = len(self._user_ids)
+                if row == len(self._values):
+                    grown = np.tile(self.DEFAULTS, (len(self._values) * 2, 1))
+                    grown[:row] = self._values
+                    self._values = grown
+                self._user_ids.append(user_id)
+                self._rows[user_id] = row
+        return row
+
+    def get(self, user_id: int) -> "Relationship":
+        """Returns the user's relationship, creating a neutral one if needed."""
+        return Relationship(self, self._row(user_id))
+
+    def set_scores(self, user_id: int, scores: Dict[str, float]):
+        row = self._row(user_id)
+        for column, name in enumerate(RELATIONSHIP_FIELDS):
+            if name in scores:
+                self._values[row, column] = float(scores[name])
+
+    def reset(self, user_id: int) -> bool:
+        """Restores default scores. Returns False if the user had no relationship yet."""
+        return self.reset_many([user_id]) > 0
+
+    def reset_many(self, user_ids) -> int:
+        rows = [self._rows[user_id] for user_id in user_ids if user_id in self._rows]
+        if rows:
+            self._values[rows] = self.DEFAULTS
+        return len(rows)
+
+    def decay(self, half_life: float, now: Optional[float] = None) -> int:
+        """Moves all scores towards the defaults by the time passed since the previous decay."""
+        now = time.time() if now is None else now
+        elapsed = max(0.0, now - self.decayed_at)
+        self.decayed_at = now
+        count = len(self._user_ids)
+        if not count or half_life <= 0:
+            return count
+        factor = 0.5 ** (elapsed / half_life)
+        values = self._values[:count]
+        values[:] = self.DEFAULTS + (values - self.DEFAULTS) * factor
+        # Neutral is derived from the other emotions, same as in Relationship.update
+        values[:, NEUTRAL_COLUMN] = np.clip(1.0 - values[:, POSITIVE_COLUMNS].sum(axis=1) - values[:, NEGATIVE_COLUMNS].sum(axis=1), 0.0, 1.0)
+        return count
+
+    def clear(self):
+        with self._lock:
+            self._values = np.tile(self.DEFAULTS, (len(self._values), 1))
+            self._user_ids = []
+            self._rows = {}
+
+    def save(self, path: str):
+        """Writes the whole table to a .npz file atomically."""
+        with self._lock:
+            count = len(self._user_ids)
+            user_ids = np.array(self._user_ids, dtype=np.int64)
+            values = self._values[:count].copy()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, user_ids=user_ids, values=values, fields=np.array(RELATIONSHIP_FIELDS), decayed_at=np.array(self.decayed_at))
+        os.replace(tmp_path, path)
+        return count
+
+    def load(self, path: str) -> int:
+        """Replaces the table with the contents of a .npz file written by save()."""
+        with np.load(path) as data:
+            user_ids = data["user_ids"].tolist()
+            loaded = data["values"]
+            fields = [str(name) for name in data["fields"]]
+            decayed_at = float(data["decayed_at"]) if "decayed_at" in data else time.time()
+        values = np.tile(self.DEFAULTS, (max(64, 2 * len(user_ids)), 1))
+        for column, name in enumerate(RELATIONSHIP_FIELDS): # By name, so added or reordered fields still load
+            if name in fields:
+                values[:len(user_ids), column] = loaded[:, fields.index(name)]
+        with self._lock:
+            self._values = values
+            self._user_ids = [int(user_id) for user_id in user_ids]
+            self._rows = {user_id: row for row, user_id in enumerate(self._user_ids)}
+            self.decayed_at = decayed_at
+        return len(user_ids)
+
+class _Score:
+    """Attribute of Relationship backed by a cell of the store table."""
+    def __init__(self, column: int):
+        self.column = column
+
+    def __get__(self, obj, objtype=None):
+        if obj is None: return self
+        return float(obj._store._values[obj._row, self.column])
+
+    def __set__(self, obj, value: float):
+        obj._store._values[obj._row, self.column] = value
+
 class Relationship:
-    def __init__(self):
-        self.infatuation = 0.0
-        self.love = 0.0
-        self.liking = 0.0
-        self.neutral = 1.0
-        self.disliking = 0.0
-        self.hatred = 0.0
-        self.trolling = 0.0
-        self.trust = 0.0
+    """One user's row in RelationshipStore."""
+    __slots__ = ("_store", "_row")
+
+    infatuation = _Score(0)
+    love = _Score(1)
+    liking = _Score(2)
+    neutral = _Score(3)
+    disliking = _Score(4)
+    hatred = _Score(5)
+    trolling = _Score(6)
+    trust = _Score(7)
+
+    def __init__(self, store: RelationshipStore, row: int):
+        self._store = store
+        self._row = row
+
+    def as_dict(self) -> Dict[str, float]:
+        return dict(zip(RELATIONSHIP_FIELDS, self._store._values[self._row].tolist()))
 
     def update(self, sentiment_score: float, message_content: str = ""):
         """Updates relationship scores based on sentiment."""
@@ -212,6 +347,8 @@ class Relationship:
                  prompt = base_style
         return prompt
 
+relationships = RelationshipStore()
+
 # --- Sentiment Analyzer ---
 analyzer = SentimentIntensityAnalyzer()
 
@@ -250,13 +387,10 @@ async def cleanup_history(context: CallbackContext):
         if key in last_activity:
             del last_activity[key]
 
-        # Also potentially reset relationship for users inactive for a long time
-        # Check if the key is a user_id (int) vs chat_id (can be negative for groups)
-        if isinstance(key, int) and key > 0 and key in user_info_db:
-            if 'relationship' in user_info_db[key]:
-                 # Reset relationship instead of deleting user data entirely
-                 user_info_db[key]['relationship'] = Relationship()
-                 logger.info(f"Reset relationship for inactive user {key}.")
+    # Also reset relationships of users inactive for a long time (in one step for all of them)
+    # Check if the key is a user_id (int) vs chat_id (can be negative for groups)
+    reset_count = relationships.reset_many([key for key in to_delete if isinstance(key, int) and key > 0])
+    if reset_count: logger.info(f"Reset relationships for {reset_count} inactive users.")
 
     if deleted_count > 0:
         logger.info(f"Cleaned up {deleted_count} histories older than {history_ttl_seconds / 3600:.1f} hours.")
@@ -377,14 +511,10 @@ async def _get_effective_style(chat_id: int, user_id: int, user_name: Optional[s
     style = group_user_style_prompts.get((chat_id, user_id))
     if style: return str(style)
 
-    relationship_obj = user_info_db.get(user_id, {}).get('relationship')
-    if relationship_obj and isinstance(relationship_obj, Relationship):
-        return relationship_obj.get_prompt(user_name)
+    if user_id in relationships:
+        return relationships.get(user_id).get_prompt(user_name)
     else:
-        # Ensure relationship object exists if needed later
-        if user_id not in user_info_db: user_info_db[user_id] = {"relationship": Relationship()}
-        elif not isinstance(user_info_db[user_id].get('relationship'), Relationship):
-             user_info_db[user_id]['relationship'] = Relationship()
+        relationships.get(user_id) # Ensure relationship exists if needed later
         return str(DEFAULT_STYLE) # Fallback to global default
 
 def _construct_prompt(history: Deque[str], chat_type: str, user_names_in_chat: Optional[Set[str]] = None) -> str:
@@ -416,9 +546,7 @@ async def update_user_info(update: Update):
     chat = update.effective_chat
 
     if user_id not in user_info_db:
-        user_info_db[user_id] = {"relationship": Relationship(), "chats": {}}
-    elif not isinstance(user_info_db[user_id].get('relationship'), Relationship):
-        user_info_db[user_id]['relationship'] = Relationship()
+        user_info_db[user_id] = {"chats": {}}
 
     user_info_db[user_id]["username"] = user.username
     user_info_db[user_id]["first_name"] = user.first_name
@@ -434,11 +562,12 @@ async def update_user_info(update: Update):
 
 async def get_user_relationship_obj(user_id: int) -> Relationship:
     """Gets or creates the Relationship object for a user."""
-    if user_id not in user_info_db:
-        user_info_db[user_id] = {"relationship": Relationship()}
-    elif not isinstance(user_info_db[user_id].get('relationship'), Relationship):
-        user_info_db[user_id]['relationship'] = Relationship()
-    return user_info_db[user_id]['relationship']
+    return relationships.get(user_id)
+
+async def decay_relationships(context: CallbackContext):
+    """Job to move all users' relationship scores back towards neutral over time."""
+    count = relationships.decay(RELATIONSHIP_DECAY_HALF_LIFE)
+    logger.debug(f"Decayed relationships of {count} users.")
 
 async def update_relationship(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Updates user relationship based on message sentiment (VADER only for now)."""
@@ -759,8 +888,7 @@ async def button_callback(update: Update, context: CallbackContext):
                  del chat_history[history_key_private]
                  cleared = True
                  logger.info(f"User {user_id} cleared their private history.")
-            if user_id in user_info_db and 'relationship' in user_info_db[user_id]:
-                 user_info_db[user_id]['relationship'] = Relationship()
+            if relationships.reset(user_id):
                  logger.info(f"Relationship reset for user {user_id}.")
                  cleared = True
             await query.edit_message_text("Готово. Наша история очищена.") if cleared else await query.edit_message_text("История и так была пуста.")
@@ -787,7 +915,7 @@ async def my_style_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     user_name = user_preferred_name.get(user_id, update.effective_user.first_name)
     relationship_obj = await get_user_relationship_obj(user_id)
-    rel_dict = relationship_obj.__dict__
+    rel_dict = relationship_obj.as_dict()
     sorted_emotions = sorted(rel_dict.items(), key=lambda item: item[1], reverse=True)
     desc = [f"{emo.capitalize()}: {val:.2f}" for emo, val in sorted_emotions if val > 0.05]
     style_info = f"Мое отношение к тебе ({user_name}):\n" + ("\n".join(desc) if desc else "Нейтральное.")
@@ -843,8 +971,7 @@ async def clear_history_command(update: Update, context: ContextTypes.DEFAULT_TY
     if target_user_id:
          cleared = False
          if target_user_id in chat_history: del chat_history[target_user_id]; cleared = True
-         if target_user_id in user_info_db and 'relationship' in user_info_db[target_user_id]:
-             user_info_db[target_user_id]['relationship'] = Relationship(); cleared = True
+         if relationships.reset(target_user_id): cleared = True
          if cleared:
               logger.info(f"Admin {update.effective_user.id} cleared history/relationship for user {target_user_id}.")
               await update.message.reply_text(f"Личная история/отношения для пользователя {target_user_id} очищены.")
@@ -1010,19 +1137,27 @@ def save_learned_responses():
         user_file_path = os.path.join(USER_DATA_DIR, f"user_{user_key}.json")
         try:
             user_data_to_save = user_data.copy()
-            if 'relationship' in user_data_to_save and isinstance(user_data_to_save['relationship'], Relationship):
-                user_data_to_save['relationship'] = user_data_to_save['relationship'].__dict__
             user_data_to_save = {str(k): v for k, v in user_data_to_save.items()} # Ensure string keys
             with open(user_file_path, "w", encoding="utf-8") as f: json.dump(user_data_to_save, f, ensure_ascii=False, indent=2)
             saved_users += 1
         except Exception as e: logger.error(f"Error saving user data for {user_key}: {e}", exc_info=True)
     if saved_users > 0: logger.info(f"Saved data for {saved_users} users to {USER_DATA_DIR}")
 
+    # --- Save relationships (one file for all users) ---
+    try:
+        saved_relationships = relationships.save(RELATIONSHIPS_FILE)
+        logger.info(f"Saved relationships of {saved_relationships} users to {RELATIONSHIPS_FILE}")
+    except Exception as e: logger.error(f"Error saving {RELATIONSHIPS_FILE}: {e}", exc_info=True)
+
 def load_user_data():
      """Loads individual user data files."""
      global user_info_db
      logger.info(f"Loading user data from {USER_DATA_DIR}...")
      user_info_db = {}
+     relationships.clear()
+     if os.path.exists(RELATIONSHIPS_FILE):
+          try: logger.info(f"Loaded relationships of {relationships.load(RELATIONSHIPS_FILE)} users from {RELATIONSHIPS_FILE}.")
+          except Exception as e: logger.error(f"Failed to load {RELATIONSHIPS_FILE}: {e}", exc_info=True)
      if not os.path.isdir(USER_DATA_DIR): logger.warning(f"User data directory '{USER_DATA_DIR}' not found."); return
      loaded_count = 0
      for filename in os.listdir(USER_DATA_DIR):
@@ -1031,12 +1166,10 @@ def load_user_data():
                try:
                     user_id = int(filename[len("user_"):-len(".json")])
                     with open(user_file_path, "r", encoding="utf-8") as f: user_data_loaded = json.load(f)
-                    # Restore Relationship object
-                    rel_data = user_data_loaded.get('relationship')
-                    if isinstance(rel_data, dict):
-                         rel_obj = Relationship(); rel_obj.__dict__.update(rel_data)
-                         user_data_loaded['relationship'] = rel_obj
-                    else: user_data_loaded['relationship'] = Relationship() # Default if missing/invalid
+                    # Older user files kept the relationship inside; move it to the store unless it is already there
+                    rel_data = user_data_loaded.pop('relationship', None)
+                    if isinstance(rel_data, dict) and user_id not in relationships:
+                         relationships.set_scores(user_id, rel_data)
                     user_info_db[user_id] = user_data_loaded
                     loaded_count +=1
                except ValueError: logger.warning(f"Skipping invalid user data filename: {filename}")
@@ -1054,6 +1187,7 @@ def initialize_data_structures():
      user_info_db = {}
      chat_history = {}
      last_activity = {}
+     relationships.clear()
      logger.info("Initialized empty data structures.")
 
 # ==============================================================================
@@ -1391,6 +1525,7 @@ class ChatBotGUI:
         if not application.job_queue: logger.warning("Job queue not available."); return
         application.job_queue.run_repeating(cleanup_history, interval=timedelta(minutes=15), first=timedelta(seconds=10))
         application.job_queue.run_repeating(cleanup_audio_files, interval=timedelta(hours=1), first=timedelta(seconds=60))
+        application.job_queue.run_repeating(decay_relationships, interval=timedelta(hours=1), first=timedelta(minutes=1))
         application.job_queue.run_repeating(self.save_settings_job, interval=timedelta(minutes=30), first=timedelta(minutes=5))
         logger.info("Job queue tasks registered.")
 
@@ -0,0 +1,179 @@
+# bench_inference.py
+# Бенчмарк локального инференса (RuBERT NER и тональность).
+# Запуск: python bench_inference.py [--texts 256] [--batch-sizes 1,2,4,8,16,32] [--waits 0,5,10,20]
+#         python bench_inference.py --parity   # сверка ONNX (int8) с PyTorch
+#         python bench_inference.py --prompt-size   # размер аннотаций в промпте: сырые выходы vs компактный формат
+#         python bench_inference.py --threads 1,2,4 [--workers 1,2]   # задержка event loop и пропускная способность
+#
+# 1) Кривая пропускной способности пайплайнов в зависимости от размера батча (прямые вызовы).
+# 2) Сквозной режим через батчер utils: много одновременных "обработчиков" при разных max_wait.
+# 3) --parity: сравнение выходов ONNX Runtime и PyTorch; код возврата 1, если расхождение выше допустимого.
+# 4) --prompt-size: сколько байт промпта занимают аннотации NER/тональности до и после компактного форматирования;
+#    код возврата 1, если компактный формат длиннее сырого или потерял сущность либо тональность.
+# 5) --threads/--workers: нагрузка через батчер при разных лимитах потоков; параллельно измеряется,
+#    насколько запаздывает event loop (то, что почувствуют обработчики Telegram).
+import argparse
+import asyncio
+import sys
+import time
+
+import utils
+from config import settings
+
+SAMPLE_TEXTS = [
+    "Привет! Как дела?",
+    "Вчера с Петей ездили в Москву, было круто",
+    "ахаха",
+    "Маша, что думаешь про новый фильм Тарантино?",
+    "Сегодня ужасная погода в Ярославле, весь день дождь",
+    "Спасибо, ты лучшая!",
+    "Кто-нибудь знает, где в Ростове Великом вкусно поесть?",
+    "Не знаю, мне кажется это плохая идея",
+]
+
+def make_texts(count: int):
+    return [SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)] + f" #{i}" for i in range(count)]
+
+def bench_direct(texts, batch_sizes):
+    print("== Прямые вызовы пайплайнов ==")
+    print(f"{'batch':>6} {'ner txt/s':>10} {'sent txt/s':>11}")
+    for batch_size in batch_sizes:
+        row = []
+        for batch_func in (utils._run_ner_batch, utils._run_sentiment_batch):
+            batch_func(texts[:batch_size]) # прогрев
+            start = time.perf_counter()
+            for i in range(0, len(texts), batch_size):
+                batch_func(texts[i:i + batch_size])
+            row.append(len(texts) / (time.perf_counter() - start))
+        print(f"{batch_size:>6} {row[0]:>10.1f} {row[1]:>11.1f}")
+
+async def bench_batcher(texts, waits, max_batch_size):
+    print(f"== Через батчер (max_batch_size={max_batch_size}, все тексты приходят одновременно) ==")
+    print(f"{'wait ms':>8} {'txt/s':>8} {'avg batch':>10}")
+    for wait_ms in waits:
+        # Без кэша результатов, чтобы измерять сам инференс
+        ner = utils.InferenceBatcher("ner", utils._run_ner_batch, wait_ms / 1000, max_batch_size, cache_size=0)
+        sentiment = utils.InferenceBatcher("sentiment", utils._run_sentiment_batch, wait_ms / 1000, max_batch_size, cache_size=0)
+        utils.metrics.observations.clear()
+        start = time.perf_counter()
+        await asyncio.gather(*(asyncio.gather(ner.infer(t), sentiment.infer(t)) for t in texts))
+        elapsed = time.perf_counter() - start
+        batch_stats = utils.metrics.observations.get("inference.ner.batch_size")
+        avg_batch = batch_stats["sum"] / batch_stats["count"] if batch_stats else 1.0
+        print(f"{wait_ms:>8} {len(texts) / elapsed:>8.1f} {avg_batch:>10.1f}")
+
+PARITY_MIN_LABEL_AGREEMENT = 0.95
+PARITY_MAX_SCORE_DIFF = 0.1
+
+def _entity_labels(entities):
+    return [(e["word"], e["entity"]) for e in entities]
+
+def check_parity(texts) -> bool:
+    print("== Сверка ONNX (int8) с PyTorch ==")
+    ok = True
+    for task, model_name, compare in (
+        ("ner", utils.NER_MODEL_NAME, _entity_labels),
+        ("sentiment-analysis", utils.SENTIMENT_MODEL_NAME, lambda result: result["label"]),
+    ):
+        torch_pipeline = utils._load_pipeline(task, model_name, backend="torch")
+        onnx_pipeline = utils._load_onnx_pipeline(task, model_name)
+        torch_results = torch_pipeline(texts)
+        onnx_results = onnx_pipeline(texts)
+        agreement = sum(compare(a) == compare(b) for a, b in zip(torch_results, onnx_results)) / len(texts)
+        if task == "sentiment-analysis":
+            score_diff = max(abs(a["score"] - b["score"]) for a, b in zip(torch_results, onnx_results))
+        else:
+            score_diff = max((abs(a["score"] - b["score"]) for ta, tb in zip(torch_results, onnx_results)
+                              if _entity_labels(ta) == _entity_labels(tb) for a, b in zip(ta, tb)), default=0.0)
+        passed = agreement >= PARITY_MIN_LABEL_AGREEMENT and score_diff <= PARITY_MAX_SCORE_DIFF
+        ok = ok and passed
+        print(f"{task}: совпадение меток {agreement:.1%}, макс. расхождение score {score_diff:.3f} -> {'OK' if passed else 'FAIL'}")
+    return ok
+
+def compare_prompt_size(texts) -> bool:
+    print("== Размер аннотаций в промпте ==")
+    print(f"{'raw B':>7} {'compact B':>10}  текст")
+    ok = True
+    raw_total = compact_total = 0
+    for text in texts:
+        entities = utils._run_ner_batch([text])[0]
+        sentiment = utils._run_sentiment_batch([text])[0]
+        raw = f"\n\nИзвлеченные сущности: {entities}\n\nТональность сообщения: {sentiment}" # прежний формат
+        annotations = utils.format_annotations(entities, sentiment)
+        compact = f"\n\nАннотации сообщения: {annotations}" if annotations else ""
+        # Компактный формат не длиннее сырого, не тащит служебные поля пайплайна и не теряет сущности и тональность
+        expected = [entity for _, entity in utils.aggregate_entities(entities)] + ([str(sentiment["label"]).lower()] if sentiment else [])
+        passed = (len(compact) <= len(raw) and "score" not in compact and "{" not in compact
+                  and all(part in annotations for part in expected))
+        ok = ok and passed
+        raw_total += len(raw.encode("utf-8"))
+        compact_total += len(compact.encode("utf-8"))
+        print(f"{len(raw.encode('utf-8')):>7} {len(compact.encode('utf-8')):>10}  {text[:40]}{'' if passed else '  FAIL'}")
+    print(f"Итого: {raw_total} -> {compact_total} байт ({1 - compact_total / raw_total:.0%} экономии)")
+    return ok
+
+LOOP_PROBE_INTERVAL = 0.005
+
+async def _probe_loop_lag(stop: asyncio.Event, lags: list):
+    """Измеряет, на сколько позже запланированного просыпается корутина."""
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(LOOP_PROBE_INTERVAL)
+        lags.append(time.perf_counter() - start - LOOP_PROBE_INTERVAL)
+
+async def bench_governor(texts, thread_counts, worker_counts):
+    print("== Ограничение CPU: пропускная способность и задержка event loop ==")
+    print(f"{'workers':>8} {'threads':>8} {'txt/s':>8} {'lag p50 ms':>11} {'lag p99 ms':>11} {'lag max ms':>11}")
+    wait = settings.INFERENCE_BATCH_MAX_WAIT_MS / 1000
+    for workers in worker_counts:
+        for threads in thread_counts:
+            # Пересоздаем пул, чтобы инициализатор потоков применил новые лимиты
+            if utils._inference_executor is not None:
+                utils._inference_executor.shutdown(wait=True)
+                utils._inference_executor = None
+            settings.INFERENCE_WORKERS = workers
+            settings.TORCH_INTRA_OP_THREADS = threads
+            ner = utils.InferenceBatcher("ner", utils._run_ner_batch, wait, settings.INFERENCE_BATCH_MAX_SIZE, cache_size=0)
+            sentiment = utils.InferenceBatcher("sentiment", utils._run_sentiment_batch, wait, settings.INFERENCE_BATCH_MAX_SIZE, cache_size=0)
+            await ner.infer(texts[0]) # прогрев потоков нового пула
+            stop, lags = asyncio.Event(), []
+            probe = asyncio.ensure_future(_probe_loop_lag(stop, lags))
+            start = time.perf_counter()
+            await asyncio.gather(*(asyncio.gather(ner.infer(t), sentiment.infer(t)) for t in texts))
+            elapsed = time.perf_counter() - start
+            stop.set()
+            await probe
+            lags.sort()
+            p50 = lags[len(lags) // 2] * 1000 if lags else 0.0
+            p99 = lags[min(len(lags) - 1, int(len(lags) * 0.99))] * 1000 if lags else 0.0
+            lag_max = lags[-1] * 1000 if lags else 0.0
+            print(f"{workers:>8} {threads:>8} {len(texts) / elapsed:>8.1f} {p50:>11.2f} {p99:>11.2f} {lag_max:>11.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк NER/тональности")
+    parser.add_argument("--texts", type=int, default=256)
+    parser.add_argument("--batch-sizes", default="1,2,4,8,16,32")
+    parser.add_argument("--waits", default="0,5,10,20")
+    parser.add_argument("--parity", action="store_true", help="сверить выходы ONNX и PyTorch")
+    parser.add_argument("--prompt-size", action="store_true", help="сравнить размер аннотаций в промпте")
+    parser.add_argument("--threads", help="список значений TORCH_INTRA_OP_THREADS, например 1,2,4")
+    parser.add_argument("--workers", help="список значений INFERENCE_WORKERS для --threads (по умолчанию текущее)")
+    args = parser.parse_args()
+
+    if args.parity:
+        sys.exit(0 if check_parity(SAMPLE_TEXTS) else 1)
+    if args.prompt_size:
+        sys.exit(0 if compare_prompt_size(SAMPLE_TEXTS) else 1)
+
+    texts = make_texts(args.texts)
+    if args.threads:
+        settings.INFERENCE_MAX_QUEUE = max(settings.INFERENCE_MAX_QUEUE, 2 * len(texts))
+        workers = [int(x) for x in args.workers.split(",")] if args.workers else [settings.INFERENCE_WORKERS]
+        asyncio.run(bench_governor(texts, [int(x) for x in args.threads.split(",")], workers))
+        return
+    bench_direct(texts, [int(x) for x in args.batch_sizes.split(",")])
+    settings.INFERENCE_MAX_QUEUE = max(settings.INFERENCE_MAX_QUEUE, 2 * len(texts))
+    asyncio.run(bench_batcher(texts, [int(x) for x in args.waits.split(",")], settings.INFERENCE_BATCH_MAX_SIZE))
+
+if __name__ == "__main__":
+    main()
@@ -1,24 +1,23 @@
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 from telegram.ext import ContextTypes, CallbackContext, CommandHandler, CallbackQueryHandler, filters
+import asyncio
 import logging
 import os
+import time
 from functools import wraps
 from typing import Any
 from dotenv import load_dotenv
-from config import BOT_NAME, DEFAULT_STYLE, SYSTEM_ROLE, USER_ROLE, ASSISTANT_ROLE, MAX_HISTORY, HISTORY_TTL
-from collections import deque
-from state import add_to_history, chat_history, last_activity, user_preferred_name, group_user_style_prompts, bot_activity_percentage
+from config import BOT_NAME, DEFAULT_STYLE, SYSTEM_ROLE, USER_ROLE, ASSISTANT_ROLE, HISTORY_TTL
+from state import (add_to_history, chat_history, last_activity, user_preferred_name, group_user_style_prompts, bot_activity_percentage,
+                   mark_dirty, mark_knowledge_dirty, set_bot_activity_percentage, clear_history, compact_data, ensure_loaded)
 from config import logger, ADMIN_USER_IDS, settings # Импортируем настройки из config
+from metrics import format_metrics
 
 # bot_commands.py
 # Этот файл содержит команды и обработчики для бота Telegram, включая команды для администраторов и пользователей.
 # Он также включает обработку ошибок и управление историей чата.
 # --- Глобальные переменные ---
 logger = logging.getLogger(__name__)
-chat_history = {}
-last_activity = {}
-user_preferred_name = {}
-group_user_style_prompts = {}
 ADMIN_USER_IDS = list(map(int, os.getenv('ADMIN_IDS', '').split(','))) if os.getenv('ADMIN_IDS') else []
 # Декораторы
 # Декоратор для проверки прав администратора
@@ -67,9 +66,9 @@ async def button_callback(update: Update, context: CallbackContext):
         user_id = int(data.split('_')[2])
         if user_id == query.from_user.id:
             if user_id in chat_history:
-                del chat_history[user_id]
                 if user_id in last_activity:
                     del last_activity[user_id]
+                clear_history(user_id)
                 await query.edit_message_text("Ваша история чата очищена.")
             else:
                 await query.edit_message_text("Ваша история чата пуста.")
@@ -83,6 +82,7 @@ async def set_my_name_command(update: Update, context: ContextTypes.DEFAULT_TYPE
     if context.args:
         name = " ".join(context.args)
         user_preferred_name[user_id] = name
+        mark_dirty(user_id)
         await update.message.reply_text(f"Отлично, теперь буду обращаться к вам как {name}.")
     else:
         await update.message.reply_text("Пожалуйста, укажите имя, которое вы хотите использовать.")
@@ -133,8 +133,9 @@ async def clear_history_command(update: Update, context: ContextTypes.DEFAULT_TY
     if context.args:
         try:
             user_id_to_clear = int(context.args[0])
+            await ensure_loaded(user_id_to_clear) # Пользователь мог быть не загружен в память
             if user_id_to_clear in chat_history:
-                del chat_history[user_id_to_clear]
+                clear_history(user_id_to_clear)
                 await update.message.reply_text(f"История чата для пользователя {user_id_to_clear} очищена.")
             else:
                 await update.message.reply_text(f"История чата для пользователя {user_id_to_clear} не найдена.")
@@ -163,6 +164,7 @@ async def set_default_style_command(update: Update, context: ContextTypes.DEFAUL
     if context.args:
         new_style = " ".join(context.args)
         settings.update_default_style(new_style)
+        mark_knowledge_dirty() # Настройки бота сохраняются вместе с общими данными
         await update.message.reply_text(f"Глобальный стиль общения бота установлен на:\n{settings.DEFAULT_STYLE}")
     else:
         await update.message.reply_text("Пожалуйста, укажите новый стиль общения.")
@@ -171,6 +173,7 @@ async def set_bot_name_command(update: Update, context: ContextTypes.DEFAULT_TYP
     if context.args:
         new_name = " ".join(context.args)
         settings.update_bot_name(new_name)
+        mark_knowledge_dirty()
         await update.message.reply_text(f"Имя бота установлено на: {settings.BOT_NAME}")
     else:
         await update.message.reply_text("Пожалуйста, укажите новое имя для бота.")
@@ -182,8 +185,7 @@ async def set_activity_command(update: Update, context: ContextTypes.DEFAULT_TYP
         try:
             percentage = int(context.args[0])
             if 0 <= percentage <= 100:
-                from state import bot_activity_percentage
-                bot_activity_percentage = percentage
+                set_bot_activity_percentage(percentage)
                 await update.message.reply_text(f"Активность бота установлена на {percentage}%")
                 logger.info(f"Bot activity set to {percentage}% by admin {update.effective_user.id}")
             else:
@@ -193,6 +195,11 @@ async def set_activity_command(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         await update.message.reply_text("Пожалуйста, укажите процент активности (0-100).")
 
+@admin_only
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает внутренние метрики бота."""
+    await update.message.reply_text(f"Метрики бота:\n{format_metrics()}")
+
 async def reset_context_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     chat_id = update.effective_chat.id
@@ -200,11 +207,19 @@ async def reset_context_command(update: Update, context: ContextTypes.DEFAULT_TY
     history_key = chat_id if chat_type in ['group', 'supergroup'] else user_id
 
     if history_key in chat_history:
-        chat_history[history_key] = deque(maxlen=MAX_HISTORY) # Очищаем историю
+        clear_history(history_key) # Очищаем историю и ее краткое содержание
         await update.message.reply_text("Контекст разговора сброшен. Можем начать заново.")
     else:
         await update.message.reply_text("Контекст разговора и так был пуст.")
 
+@admin_only
+async def compact_storage_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Полностью переписывает все данные и уплотняет хранилище (периодическое сохранение пишет только изменения)."""
+    await update.message.reply_text("Уплотняю хранилище...")
+    start = time.monotonic()
+    await asyncio.to_thread(compact_data)
+    await update.message.reply_text(f"Хранилище уплотнено за {time.monotonic() - start:.1f} с.")
+
 # --- Команда помощи ---
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     help_text = "Доступные команды:\n\n"
@@ -223,7 +238,9 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ("/set_default_style <стиль>", "Установить глобальный стиль общения бота."),
         ("/set_group_user_style <стиль>", "Установить стиль общения для конкретного пользователя в группе."),
         ("/reset_style", "Сбросить глобальный стиль общения бота на стандартный."),
-        ("/set_activity <0-100>", "Установить процент активности бота.")
+        ("/set_activity <0-100>", "Установить процент активности бота."),
+        ("/stats", "Показать внутренние метрики бота."),
+        ("/compact_storage", "Полностью переписать и уплотнить хранилище данных.")
     ]
 
     user_id = update.effective_user.id
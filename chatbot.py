@@ -3,7 +3,7 @@ from pathlib import Path
 from dotenv import load_dotenv
 from typing import Dict, Set, Deque, Optional
 from collections import deque
-from functools import wraps, lru_cache
+from functools import wraps
 import logging
 from logging.handlers import RotatingFileHandler
 import time
@@ -29,6 +29,7 @@ from io import BytesIO
 
 import requests
 from bs4 import BeautifulSoup
+from response_cache import ResponseCache
 
 # Загрузка конфигурации
 env_path = Path('.') / '.env'
@@ -46,6 +47,8 @@ class BotSettings:
         self.BOT_NAME = os.getenv('BOT_NAME', "Маша")
         self.HISTORY_TTL = int(os.getenv('HISTORY_TTL', '86400'))
         self.GLOBAL_PROACTIVE_PROBABILITY = float(os.getenv('GLOBAL_PROACTIVE_PROBABILITY', '0.3')) # По умолчанию 30%
+        self.LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+        self.LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', '21600'))
 
     def update_default_style(self, new_style: str):
         self.DEFAULT_STYLE = new_style
@@ -70,6 +73,7 @@ user_info_db: Dict[int, Dict[str, any]] = {} # Key теперь всегда use
 group_preferences: Dict[int, Dict[str, str]] = {} # chat_id: {"style": "rude"}
 KNOWLEDGE_FILE = "learned_knowledge.json" # Имя файла для сохранения общих знаний
 USER_DATA_DIR = "user_data" # Директория для хранения файлов пользователей
+LLM_CACHE_FILE = "llm_cache.json" # Файл для сохранения кэша ответов Gemini
 last_bot_message_to_user_in_group: Dict[int, str] = {} # user_id: last_bot_message
 chat_proactive_probabilities: Dict[int, float] = {}
 user_muted_in_chat: Dict[int, Set[int]] = {} # chat_id: {user_id1, user_id2, ...}
@@ -91,7 +95,10 @@ logger.addHandler(handler)
 
 # Инициализация Gemini
 genai.configure(api_key=API_KEY)
-model = genai.GenerativeModel('gemini-2.0-flash-thinking-exp-01-21')
+GEMINI_MODEL_NAME = 'gemini-2.0-flash-thinking-exp-01-21'
+model = genai.GenerativeModel(GEMINI_MODEL_NAME)
+response_cache = ResponseCache(settings.LLM_CACHE_MAX_BYTES, settings.LLM_CACHE_TTL,
+                               path=LLM_CACHE_FILE, namespace=GEMINI_MODEL_NAME, log=logger)
 
 # Структуры данных
 chat_history: Dict[int, Deque[str]] = {}
@@ -131,13 +138,18 @@ def add_to_history(key: int, role: str, message: str, user_name: Optional[str] =
         chat_history[key].append(f"{role}: {message}")
     last_activity[key] = time.time()
 
-@lru_cache(maxsize=100)
 def generate_content(prompt: str) -> str:
+    cached = response_cache.get(prompt)
+    if cached is not None:
+        return cached
     logger.info(f"Generate content prompt: {prompt}")
     try:
         response = model.generate_content(prompt)
         logger.info(f"Generate content response type: {type(response)}")
-        return response.text if hasattr(response, 'text') else "Не удалось сгенерировать ответ."
+        if not hasattr(response, 'text'):
+            return "Не удалось сгенерировать ответ."
+        response_cache.put(prompt, response.text)
+        return response.text
     except Exception as e:
         logger.error(f"Generation error: {e}")
         return "Произошла ошибка при обработке запроса."
@@ -1240,6 +1252,7 @@ def main():
     try:
         global learned_responses, user_info_db, group_preferences, chat_history, settings, DEFAULT_STYLE, BOT_NAME, last_bot_message_to_user_in_group, chat_proactive_probabilities, user_muted_in_chat, bot_was_recently_corrected
         load_learned_responses()
+        response_cache.load()
         DEFAULT_STYLE = settings.DEFAULT_STYLE
         BOT_NAME = settings.BOT_NAME
 
@@ -1254,6 +1267,7 @@ def main():
 
         logger.info("Bot stopped. Saving learned responses and user info...")
         save_learned_responses(learned_responses, user_info_db, group_preferences, chat_history, last_bot_message_to_user_in_group, chat_proactive_probabilities, user_muted_in_chat, bot_was_recently_corrected) # Передаем новые данные для сохранения
+        response_cache.save()
 
     except Exception as e:
         logger.critical(f"Failed to start bot: {e}")
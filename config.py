@@ -22,6 +22,70 @@ class BotSettings:
         self.DEFAULT_STYLE = os.getenv('DEFAULT_STYLE', "Ты - Маша, 25-летняя девушка из Ростова Великого. Ты очень веселая и раскрепощенная. Твой стиль общения непринужденный, эмоциональный, ты не стесняешься в выражениях и можешь использовать любую лексику, включая нецензурную если она уместна. Отвечай от первого лица, как будто ты - Маша.Подстраивайся под стиль общения собеседника")
         self.BOT_NAME = os.getenv('BOT_NAME', 'Маша')
         self.HISTORY_TTL = int(os.getenv('HISTORY_TTL', '86400')) # Время жизни истории в секундах (1 день)
+        self.PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', '3000')) # Бюджет токенов на промпт (история заполняет остаток)
+        # Фоновое сжатие старых реплик в краткое содержание
+        self.SUMMARIZATION_ENABLED = os.getenv('SUMMARIZATION_ENABLED', 'true').lower() == 'true'
+        self.SUMMARY_TRIGGER_ENTRIES = int(os.getenv('SUMMARY_TRIGGER_ENTRIES', '20')) # Должно быть меньше MAX_HISTORY
+        self.SUMMARY_KEEP_RECENT = int(os.getenv('SUMMARY_KEEP_RECENT', '8')) # Сколько последних реплик оставлять как есть
+        self.SUMMARY_INTERVAL = int(os.getenv('SUMMARY_INTERVAL', '60')) # Период фоновой задачи сжатия (сек)
+        self.SUMMARY_RETRY_DELAY = int(os.getenv('SUMMARY_RETRY_DELAY', '600')) # Пауза перед повторным сжатием истории после ошибки (сек)
+        # Асинхронный клиент Gemini
+        self.GEMINI_MAX_CONCURRENCY = int(os.getenv('GEMINI_MAX_CONCURRENCY', '16')) # Максимум одновременных запросов к Gemini
+        self.GEMINI_WARMUP = os.getenv('GEMINI_WARMUP', 'true').lower() == 'true' # Прогревать соединение с Gemini при старте
+        # Политика вызовов Gemini: общий дедлайн, повторы с экспоненциальной задержкой, хеджирование
+        self.GEMINI_DEADLINE = float(os.getenv('GEMINI_DEADLINE', '30')) # Общий бюджет времени на запрос, включая повторы (сек)
+        self.GEMINI_MAX_RETRIES = int(os.getenv('GEMINI_MAX_RETRIES', '3')) # Повторы при временных ошибках (429, 5xx, таймауты)
+        self.GEMINI_RETRY_BASE_DELAY = float(os.getenv('GEMINI_RETRY_BASE_DELAY', '0.5'))
+        self.GEMINI_RETRY_MAX_DELAY = float(os.getenv('GEMINI_RETRY_MAX_DELAY', '8'))
+        self.GEMINI_HEDGING = os.getenv('GEMINI_HEDGING', 'false').lower() == 'true' # Дублировать запрос, если он дольше p95
+        # Потоковые ответы (первое предложение отправляется сразу, затем сообщение редактируется)
+        self.STREAM_REPLIES = os.getenv('STREAM_REPLIES', 'false').lower() == 'true'
+        self.STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5')) # Мин. интервал между правками в ЛС (сек)
+        self.STREAM_GROUP_EDIT_INTERVAL = float(os.getenv('STREAM_GROUP_EDIT_INTERVAL', '3.5')) # В группах лимиты Telegram строже (~20 сообщений/мин)
+        # Сколько обновлений обрабатывается одновременно (обновления одного чата - всегда по очереди); 1 - строго по одному, окна пакетирования тогда отключаются
+        self.CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))
+        # Пакетная проверка контекста: проверки из всех чатов собираются за короткое окно и отправляются одним запросом
+        self.CONTEXT_BATCH_WINDOW_MS = int(os.getenv('CONTEXT_BATCH_WINDOW_MS', '40')) # 0 - отключить пакетирование
+        self.CONTEXT_BATCH_MAX_SIZE = int(os.getenv('CONTEXT_BATCH_MAX_SIZE', '20'))
+        # Бэкенд локальных моделей NER/тональности: torch (PyTorch) или onnx (ONNX Runtime, int8, нужен optimum[onnxruntime])
+        self.INFERENCE_BACKEND = os.getenv('INFERENCE_BACKEND', 'torch').lower()
+        self.ONNX_CACHE_DIR = os.getenv('ONNX_CACHE_DIR', 'onnx_models') # Кэш экспортированных и квантизованных моделей
+        self.ML_WARMUP = os.getenv('ML_WARMUP', 'true').lower() == 'true' # Загружать модели в фоне сразу при старте
+        # Локальная копия моделей в формате safetensors: быстрая загрузка без обращения к хабу (веса все равно копируются в память процесса)
+        self.MODEL_CACHE_DIR = os.getenv('MODEL_CACHE_DIR', '') # Например models; пусто - загружать напрямую из кэша HF, как раньше
+        # Пул потоков для локального инференса (NER, тональность, эмбеддинги), чтобы не блокировать event loop
+        self.INFERENCE_WORKERS = int(os.getenv('INFERENCE_WORKERS', '2'))
+        # Ограничение CPU для инференса: одновременно выполняется не больше INFERENCE_WORKERS вызовов моделей,
+        # каждый в TORCH_INTRA_OP_THREADS потоков (0 - поровну делить ядра, оставив INFERENCE_RESERVED_CPUS для event loop, ffmpeg и GUI)
+        self.TORCH_INTRA_OP_THREADS = int(os.getenv('TORCH_INTRA_OP_THREADS', '0'))
+        self.TORCH_INTEROP_THREADS = int(os.getenv('TORCH_INTEROP_THREADS', '1'))
+        self.INFERENCE_RESERVED_CPUS = int(os.getenv('INFERENCE_RESERVED_CPUS', '1'))
+        self.INFERENCE_CPU_AFFINITY = os.getenv('INFERENCE_CPU_AFFINITY', '') # Ядра для потоков инференса, например "2-3" или "1,3"; пусто - без привязки
+        self.INFERENCE_MAX_QUEUE = int(os.getenv('INFERENCE_MAX_QUEUE', '32')) # При большей очереди обогащение пропускается
+        self.INFERENCE_BATCH_MAX_SIZE = int(os.getenv('INFERENCE_BATCH_MAX_SIZE', '16')) # Максимальный размер батча NER/тональности
+        self.INFERENCE_BATCH_MAX_WAIT_MS = int(os.getenv('INFERENCE_BATCH_MAX_WAIT_MS', '10')) # Ожидание добора батча; 0 - без батчинга
+        self.ENRICH_MIN_CHARS = int(os.getenv('ENRICH_MIN_CHARS', '8')) # Более короткие сообщения не прогоняются через NER/тональность
+        self.ENTITY_MIN_SCORE = float(os.getenv('ENTITY_MIN_SCORE', '0.6')) # Сущности с меньшей уверенностью не попадают в промпт
+        self.INFERENCE_CACHE_SIZE = int(os.getenv('INFERENCE_CACHE_SIZE', '4096')) # Записей в LRU-кэше результатов на каждый пайплайн
+        # Локальная проверка контекста по эмбеддингам: очевидные случаи решаются без запроса к Gemini
+        self.CONTEXT_EMBEDDINGS_ENABLED = os.getenv('CONTEXT_EMBEDDINGS_ENABLED', 'true').lower() == 'true'
+        self.EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'cointegrated/rubert-tiny2')
+        self.CONTEXT_SIMILARITY_HIGH = float(os.getenv('CONTEXT_SIMILARITY_HIGH', '0.8')) # Не ниже - сообщение считается продолжением
+        self.CONTEXT_SIMILARITY_LOW = float(os.getenv('CONTEXT_SIMILARITY_LOW', '0.3')) # Не выше - сообщение считается новым
+        # Хранилище данных: json (learned_knowledge.json + user_data/) или sqlite (bot_data.db; при первом запуске туда переносятся JSON-файлы)
+        self.STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'json').lower()
+        self.STORAGE_FSYNC = os.getenv('STORAGE_FSYNC', 'false').lower() == 'true' # fsync при каждой записи (надежнее при отключении питания, но медленнее)
+        # Журнал историй: новый сегмент начинается после HISTORY_SEGMENT_MAX_BYTES, уплотнение - когда сегментов больше HISTORY_LOG_MAX_SEGMENTS
+        self.HISTORY_SEGMENT_MAX_BYTES = int(os.getenv('HISTORY_SEGMENT_MAX_BYTES', str(4 * 1024 * 1024)))
+        self.HISTORY_LOG_MAX_SEGMENTS = int(os.getenv('HISTORY_LOG_MAX_SEGMENTS', '8'))
+        # Ленивая загрузка: при старте строится только индекс, данные пользователя и чата читаются при первом обращении
+        self.LAZY_LOADING = os.getenv('LAZY_LOADING', 'false').lower() == 'true'
+        self.EVICT_IDLE_AFTER = int(os.getenv('EVICT_IDLE_AFTER', '3600')) # Через сколько секунд без обращений данные выгружаются из памяти
+        self.PERSIST_DELAY = float(os.getenv('PERSIST_DELAY', '2')) # Сколько секунд копить изменения перед фоновой записью
+        self.PERSIST_SHUTDOWN_DEADLINE = float(os.getenv('PERSIST_SHUTDOWN_DEADLINE', '10')) # Сколько ждать финальной записи при остановке
+        # Кэш ответов LLM
+        self.LLM_CACHE_MAX_BYTES = int(os.getenv('LLM_CACHE_MAX_BYTES', str(8 * 1024 * 1024))) # Максимальный объем кэша (8 MB)
+        self.LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', '21600')) # Время жизни записи кэша в секундах (6 часов)
 
     def update_default_style(self, new_style: str):
         self.DEFAULT_STYLE = new_style
@@ -44,6 +108,19 @@ DEFAULT_STYLE = settings.DEFAULT_STYLE
 BOT_NAME = settings.BOT_NAME
 HISTORY_TTL = settings.HISTORY_TTL
 
+def reload_env(dotenv_path):
+    """Перечитывает .env и обновляет настройки на месте (используется launcher.py в дочерних процессах)."""
+    global TELEGRAM_BOT_TOKEN, GEMINI_API_KEY, ADMIN_USER_IDS, MAX_HISTORY, DEFAULT_STYLE, BOT_NAME, HISTORY_TTL
+    load_dotenv(dotenv_path=dotenv_path, override=True)
+    TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+    GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
+    ADMIN_USER_IDS = list(map(int, os.getenv('ADMIN_IDS', '').split(','))) if os.getenv('ADMIN_IDS') else []
+    settings.__init__() # Тот же объект, поэтому модули, импортировавшие settings, видят новые значения
+    MAX_HISTORY = settings.MAX_HISTORY
+    DEFAULT_STYLE = settings.DEFAULT_STYLE
+    BOT_NAME = settings.BOT_NAME
+    HISTORY_TTL = settings.HISTORY_TTL
+
 # --- Роли для истории чата ---
 USER_ROLE = "User"
 ASSISTANT_ROLE = "Assistant"
@@ -52,6 +129,9 @@ SYSTEM_ROLE = "System"
 # --- Константы для файлов и директорий ---
 KNOWLEDGE_FILE = "learned_knowledge.json"
 USER_DATA_DIR = "user_data"
+LLM_CACHE_FILE = "llm_cache.json"
+DATABASE_FILE = "bot_data.db" # База SQLite при STORAGE_BACKEND=sqlite
+HISTORY_LOG_DIR = "history_log" # Сегменты журнала историй чатов
 
 # --- Промпт для проверки контекста ---
 CONTEXT_CHECK_PROMPT = f"""Ты - эксперт по определению контекста диалога. Тебе нужно решить, является ли следующее сообщение пользователя логическим продолжением или прямым ответом на предыдущее сообщение бота. Сообщение пользователя должно относиться к той же теме, продолжать обсуждение или отвечать на вопрос, заданный ботом.
@@ -62,6 +142,23 @@ CONTEXT_CHECK_PROMPT = f"""Ты - эксперт по определению к
 Ответь строго "Да", если сообщение пользователя является продолжением или ответом, и "Нет", если это новое, не связанное сообщение. Не давай никаких дополнительных объяснений.
 """
 
+# --- Промпт для сжатия старой части диалога ---
+SUMMARY_PROMPT = """Сожми диалог в краткое содержание на русском языке (не больше 5-7 предложений). Сохрани важные факты о собеседниках, их имена, предпочтения, договоренности и незакрытые вопросы. Пиши в третьем лице, без вступлений и пояснений.
+
+Предыдущее краткое содержание: {previous_summary}
+
+Новая часть диалога:
+{dialogue}
+"""
+
+# --- Промпт для пакетной проверки контекста (несколько независимых пар за один запрос) ---
+CONTEXT_BATCH_CHECK_PROMPT = """Ты - эксперт по определению контекста диалога. Ниже приведены {count} независимых пар сообщений. Для каждой пары реши, является ли сообщение пользователя логическим продолжением или прямым ответом на предыдущее сообщение бота: относится к той же теме, продолжает обсуждение или отвечает на вопрос, заданный ботом.
+
+{items}
+
+Ответь строго по одной строке на каждую пару в формате "<номер>: Да" или "<номер>: Нет", в порядке номеров. Не давай никаких дополнительных объяснений.
+"""
+
 # --- Настройка логирования ---
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -2,27 +2,43 @@
 import asyncio
 import os
 import random
+import re
 from io import BytesIO
 from collections import deque
 import time
 from PIL import Image
 from telegram import Update, constants
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import ContextTypes
 import pydub
 from pydub import AudioSegment
 
-from config import (ASSISTANT_ROLE, BOT_NAME, DEFAULT_STYLE, SYSTEM_ROLE, USER_ROLE,
+from config import (ASSISTANT_ROLE, BOT_NAME, DEFAULT_STYLE, USER_ROLE,
                     logger, settings)
-from state import (add_to_history, chat_history, learned_responses,
-                   user_preferred_name, user_topic)
-from utils import (filter_response, generate_content_sync, generate_vision_content_async,
+from state import (add_to_history, chat_history, chat_metadata, chat_summaries, learned_responses, ensure_loaded,
+                   mark_response_learned, set_chat_metadata, user_preferred_name, user_topic)
+from utils import (filter_response, generate_content_async, generate_vision_content_async,
                    is_context_related, transcribe_voice, update_user_info,
                    _get_effective_style, should_process_message,
-                   get_bot_activity_percentage, get_ner_pipeline,
-                   get_sentiment_pipeline, PromptBuilder)
+                   get_bot_activity_percentage, analyze_text, PromptBuilder, response_cache,
+                   stream_content_async, ResponseBlockedError)
 
 prompt_builder = PromptBuilder(settings.BOT_NAME, DEFAULT_STYLE)
 
+SENTENCE_END_RE = re.compile(r"[.!?…](?=\s|$)")
+
+async def _send_reply(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    if update.effective_chat.type == 'private':
+        return await context.bot.send_message(chat_id=update.effective_chat.id, text=text, parse_mode=None)
+    return await update.message.reply_text(text, parse_mode=None)
+
+def _remember_reply(history_key: int, filtered: str, original_input: str):
+    add_to_history(history_key, ASSISTANT_ROLE, filtered)
+    if len(original_input.split()) < 10:
+        learned_responses[original_input] = filtered
+        mark_response_learned(original_input)
+        logger.info(f"Learned response for '{original_input[:50]}...': '{filtered[:50]}...'")
+
 async def _process_generation_and_reply(
     update: Update,
     context: ContextTypes.DEFAULT_TYPE,
@@ -31,28 +47,24 @@ async def _process_generation_and_reply(
     original_input: str
 ):
     chat_id = update.effective_chat.id
-    chat_type = update.effective_chat.type
 
     await context.bot.send_chat_action(chat_id=chat_id, action=constants.ChatAction.TYPING)
     await asyncio.sleep(random.uniform(0.4, 1.2))
 
-    response = await asyncio.to_thread(generate_content_sync, prompt)
+    if settings.STREAM_REPLIES:
+        await _stream_generation_and_reply(update, context, history_key, prompt, original_input)
+        return
+
+    response = await generate_content_async(prompt)
     logger.info(f"Raw Gemini response for key {history_key}: {response[:100]}...")
 
     filtered = filter_response(response)
     logger.info(f"Filtered response for key {history_key}: {filtered[:100]}...")
 
     if filtered and not filtered.startswith("["):
-        add_to_history(history_key, ASSISTANT_ROLE, filtered)
         logger.debug(f"Sending response to chat {chat_id}")
-        if chat_type == 'private':
-            await context.bot.send_message(chat_id=chat_id, text=filtered, parse_mode=None)
-        else:
-            await update.message.reply_text(filtered, parse_mode=None)
-
-        if len(original_input.split()) < 10:
-            learned_responses[original_input] = filtered
-            logger.info(f"Learned response for '{original_input[:50]}...': '{filtered[:50]}...'")
+        await _send_reply(update, context, filtered)
+        _remember_reply(history_key, filtered, original_input)
     elif filtered.startswith("["):
          logger.warning(f"Response from Gemini indicates an issue: {filtered}")
          await update.message.reply_text("Извините, не могу сейчас ответить на это. Попробуйте переформулировать.")
@@ -61,6 +73,97 @@ async def _process_generation_and_reply(
         await update.message.reply_text("Простите, у меня возникли сложности с ответом. Попробуйте еще раз или задайте другой вопрос.")
 
 
+async def _stream_generation_and_reply(
+    update: Update,
+    context: ContextTypes.DEFAULT_TYPE,
+    history_key: int,
+    prompt: str,
+    original_input: str
+):
+    """Отправляет первое предложение ответа сразу, затем дописывает сообщение правками с ограничением частоты."""
+    chat_id = update.effective_chat.id
+    edit_interval = settings.STREAM_EDIT_INTERVAL if update.effective_chat.type == 'private' else settings.STREAM_GROUP_EDIT_INTERVAL
+
+    response = response_cache.get(prompt) or ""
+    sent_message = None
+    sent_text = ""
+    next_edit_at = 0.0
+
+    async def show(text: str):
+        nonlocal sent_message, sent_text, next_edit_at
+        if text == sent_text:
+            return
+        try:
+            if sent_message is None:
+                sent_message = await _send_reply(update, context, text)
+            else:
+                await sent_message.edit_text(text, parse_mode=None)
+            sent_text = text
+            next_edit_at = time.monotonic() + edit_interval
+        except RetryAfter as e:
+            logger.warning(f"Telegram flood control while streaming to chat {chat_id}, retry after {e.retry_after}s")
+            next_edit_at = time.monotonic() + float(e.retry_after)
+        except BadRequest as e:
+            logger.debug(f"Skipping streamed edit for chat {chat_id}: {e}")
+
+    if not response:
+        try:
+            async for chunk in stream_content_async(prompt):
+                response += chunk
+                if response.lstrip().startswith("[") or time.monotonic() < next_edit_at:
+                    continue
+                partial = filter_response(response)
+                if sent_message is None:
+                    # Первое сообщение — как только готово хотя бы одно полное предложение
+                    sentence_ends = [m.end() for m in SENTENCE_END_RE.finditer(partial)]
+                    if sentence_ends:
+                        await show(partial[:sentence_ends[-1]])
+                elif partial:
+                    await show(partial)
+        except ResponseBlockedError as e:
+            # Уже отправленная часть остается, текст блокировки не показывается, не кэшируется и не запоминается
+            logger.warning(f"Gemini stream blocked for key {history_key}. Reason: {e}")
+            response = f"[Ответ заблокирован: {e}]"
+        except Exception as e:
+            logger.error(f"Gemini streaming error for key {history_key}: {e}", exc_info=True)
+            response = f"[Произошла ошибка при генерации ответа: {type(e).__name__}]"
+        else:
+            response_cache.put(prompt, response)
+    logger.info(f"Raw streamed Gemini response for key {history_key}: {response[:100]}...")
+
+    filtered = filter_response(response)
+    logger.info(f"Filtered response for key {history_key}: {filtered[:100]}...")
+
+    if filtered and not filtered.startswith("["):
+        for _ in range(3):
+            if time.monotonic() < next_edit_at:
+                await asyncio.sleep(next_edit_at - time.monotonic())
+            await show(filtered)
+            if sent_text == filtered:
+                break
+        if sent_text == filtered:
+            _remember_reply(history_key, filtered, original_input)
+        else:
+            logger.warning(f"Final streamed text was not delivered to chat {chat_id}")
+    elif sent_message is not None:
+        # Начало ответа уже отправлено, но итог пустой или с ошибкой — оставляем отправленную часть в истории
+        logger.warning(f"Stream for key {history_key} ended with an issue after partial delivery: {filtered[:100]}")
+        add_to_history(history_key, ASSISTANT_ROLE, sent_text)
+    elif filtered.startswith("["):
+        logger.warning(f"Response from Gemini indicates an issue: {filtered}")
+        await update.message.reply_text("Извините, не могу сейчас ответить на это. Попробуйте переформулировать.")
+    else:
+        logger.warning(f"Filtered response was empty for key {history_key}. Original: {response[:100]}...")
+        await update.message.reply_text("Простите, у меня возникли сложности с ответом. Попробуйте еще раз или задайте другой вопрос.")
+
+
+async def load_update_state(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Выполняется до остальных обработчиков при LAZY_LOADING: подгружает данные пользователя и группового чата."""
+    if update.effective_user:
+        await ensure_loaded(update.effective_user.id)
+    if update.effective_chat and update.effective_chat.type in ['group', 'supergroup']:
+        await ensure_loaded(update.effective_chat.id)
+
 async def handle_text_voice_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
     chat = update.effective_chat
@@ -190,36 +293,31 @@ async def handle_text_voice_video(update: Update, context: ContextTypes.DEFAULT_
     user_name = user_preferred_name.get(user_id, user.first_name)
     history_key = chat_id if chat_type in ['group', 'supergroup'] else user_id
 
-    ner_model = get_ner_pipeline()
-    entities = ner_model(prompt_text) if ner_model else None
-    logger.info(f"RuBERT Entities: {entities}")
-
-    sentiment_model = get_sentiment_pipeline()
-    sentiment_result = sentiment_model(prompt_text) if sentiment_model else None
-    sentiment = sentiment_result[0] if sentiment_result else None
-    logger.info(f"RuBERT Sentiment: {sentiment}")
-
     if chat_type == 'private':
         logger.info(f"Processing {message_type} message from {user_name} ({user_id}).")
+        # Обогащение выполняется только для сообщений, на которые бот точно будет отвечать
+        entities, sentiment = await analyze_text(prompt_text)
+        logger.info(f"RuBERT Entities: {entities}")
+        logger.info(f"RuBERT Sentiment: {sentiment}")
+
         effective_style = await _get_effective_style(chat_id, user_id, user_name, chat_type)
         system_message_base = f"{effective_style} Ты - {settings.BOT_NAME}. Не начинай свои ответы с приветствия, если пользователь не поприветствовал тебя в своем сообщении."
         topic = user_topic.get(user_id)
         topic_context = f"Тема: {topic}." if topic else ""
 
         add_to_history(history_key, USER_ROLE, prompt_text, user_name=user_name if chat_type != 'private' else None)
-        add_to_history(history_key, SYSTEM_ROLE, f"{system_message_base} {topic_context}")
+        set_chat_metadata(history_key, style=system_message_base, topic=topic_context)
 
         current_history = chat_history.get(history_key, deque())
-        history_str = "\n".join(current_history)
 
         prompt = prompt_builder.build_prompt(
-            history_str=history_str,
+            history=current_history,
             user_name=user_name,
             prompt_text=prompt_text,
-            system_message_base=system_message_base,
-            topic_context=topic_context,
+            metadata=chat_metadata.get(history_key),
             entities=entities,
-            sentiment=sentiment
+            sentiment=sentiment,
+            summary=chat_summaries.get(history_key)
         )
 
         await _process_generation_and_reply(update, context, history_key, prompt, prompt_text)
@@ -241,25 +339,28 @@ async def handle_text_voice_video(update: Update, context: ContextTypes.DEFAULT_
         if mentioned or is_reply_to_bot or is_related:
             logger.info(f"Processing {message_type} message from {user_name} ({user_id}). Reason: M={mentioned}, R={is_reply_to_bot}, C={is_related}")
 
+            entities, sentiment = await analyze_text(prompt_text)
+            logger.info(f"RuBERT Entities: {entities}")
+            logger.info(f"RuBERT Sentiment: {sentiment}")
+
             effective_style = await _get_effective_style(chat_id, user_id, user_name, chat_type)
             system_message_base = f"{effective_style} Обращайся к {user_name}. Отвечай от первого лица как {settings.BOT_NAME}. Не начинай свои ответы с приветствия, если пользователь не поприветствовал тебя в своем сообщении."
             topic = user_topic.get(user_id)
             topic_context = f"Тема: {topic}." if topic else ""
 
             add_to_history(history_key, USER_ROLE, prompt_text, user_name=user_name if chat_type != 'private' else None)
-            add_to_history(history_key, SYSTEM_ROLE, f"{system_message_base} {topic_context}")
+            set_chat_metadata(history_key, style=system_message_base, topic=topic_context)
 
             current_history = chat_history.get(history_key, deque())
-            history_str = "\n".join(current_history)
 
             prompt = prompt_builder.build_prompt(
-                history_str=history_str,
+                history=current_history,
                 user_name=user_name,
                 prompt_text=prompt_text,
-                system_message_base=system_message_base,
-                topic_context=topic_context,
+                metadata=chat_metadata.get(history_key),
                 entities=entities,
-                sentiment=sentiment
+                sentiment=sentiment,
+                summary=chat_summaries.get(history_key)
             )
 
             await _process_generation_and_reply(update, context, history_key, prompt, prompt_text)
@@ -299,28 +400,22 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         topic_context = f"Тема: {topic}." if topic else ""
 
         add_to_history(history_key, USER_ROLE, f"Получено фото от {user_name}" + (f" с подписью: '{caption}'" if caption else ""), user_name=user_name if chat_type != 'private' else None)
-        add_to_history(history_key, SYSTEM_ROLE, f"{system_message_base} {topic_context}")
+        set_chat_metadata(history_key, style=system_message_base, topic=topic_context)
 
         current_history = chat_history.get(history_key, deque())
-        history_str = "\n".join(current_history)
 
-        ner_model = get_ner_pipeline()
-        entities = ner_model(caption) if ner_model else None
+        entities, sentiment = await analyze_text(caption)
         logger.info(f"RuBERT Entities (photo caption): {entities}")
-
-        sentiment_model = get_sentiment_pipeline()
-        sentiment_result = sentiment_model(caption) if sentiment_model else None
-        sentiment = sentiment_result[0] if sentiment_result else None
         logger.info(f"RuBERT Sentiment (photo caption): {sentiment}")
 
         prompt = prompt_builder.build_prompt(
-            history_str=history_str,
+            history=current_history,
             user_name=user_name,
             prompt_text=caption,
-            system_message_base=system_message_base,
-            topic_context=topic_context,
+            metadata=chat_metadata.get(history_key),
             entities=entities,
-            sentiment=sentiment
+            sentiment=sentiment,
+            summary=chat_summaries.get(history_key)
         )
 
         vision_prompt = f"Сопроводи это изображение ответом, основанным на следующем запросе: {prompt}"
@@ -0,0 +1,312 @@
+# history_log.py
+# Журнал историй чатов только на дозапись (append-only), разбитый на сегменты.
+#
+# Каждая строка сегмента - JSON-запись для одного ключа истории (id пользователя или чата, включая группы):
+#   {"k": key, "t": time, "e": entry}      - добавлена реплика
+#   {"k": key, "t": time, "b": [entries], "s": summary}
+#                                          - базовая запись: история ключа целиком (после очистки, сжатия
+#                                            и т.п.) и краткое содержание ее начала ("s" только если оно есть);
+#                                            пустой список без "s" означает, что история удалена
+# Запись на диск идет из фонового потока сохранения: обработчики только кладут записи в буфер.
+# Уплотнение пишет базовые записи всех живых историй (не длиннее MAX_HISTORY) в новый сегмент и удаляет
+# предыдущие, поэтому при старте проигрывается только хвост журнала после последнего уплотнения.
+#
+# При ленивой загрузке (LAZY_LOADING) журнал не проигрывается целиком: build_index запоминает для каждого ключа
+# только положение его актуальных записей в сегментах, а сама история читается через load при первом обращении.
+import json
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from config import logger
+
+SEGMENT_RE = re.compile(r"^segment_(\d+)\.jsonl$")
+# Начало строки записи: json.dumps сохраняет порядок полей, поэтому ключ и время разбираются без разбора всей строки
+RECORD_HEAD_RE = re.compile(rb'^\{"k": (-?\d+), "t": ([^,]+), "(e|b)": ')
+
+
+class HistoryLog:
+    def __init__(self, directory: str, segment_max_bytes: int, max_segments: int, fsync: bool = False):
+        self.directory = directory
+        self.segment_max_bytes = segment_max_bytes
+        self.max_segments = max_segments
+        self.fsync = fsync
+        # Изменение истории и постановка записи в буфер должны идти под этой блокировкой, иначе снимок для
+        # уплотнения может разойтись с буфером (state.add_to_history и state.rebase_history)
+        self.lock = threading.Lock()
+        self._pending: List[dict] = []
+        self._segments: List[int] = []
+        self._active = None
+        self._active_size = 0
+        # Индекс ленивой загрузки: {ключ: (время последней записи, [(сегмент, смещение, длина), ...], положение базовой
+        # записи с кратким содержанием или None)}; None - без индекса. Базовая запись с кратким содержанием хранится
+        # отдельно: после maxlen добавлений она выпадает из списка, а краткое содержание остается актуальным.
+        # Файлы сегментов меняют только flush и compact, load читает их - все трое под _io_lock
+        self._index: Optional[Dict[int, Tuple[float, List[Tuple[int, int, int]], Optional[Tuple[int, int, int]]]]] = None
+        self._index_maxlen = 0
+        self._io_lock = threading.Lock()
+
+    # --- Запись (буфер заполняется из event loop, на диск пишет поток сохранения) ---
+
+    def record_append(self, key: int, entry: str):
+        self._pending.append({"k": key, "t": time.time(), "e": entry})
+
+    def record_base(self, key: int, entries: List[str], summary: Optional[str] = None):
+        record = {"k": key, "t": time.time(), "b": entries}
+        if summary:
+            record["s"] = summary
+        self._pending.append(record)
+
+    def _segment_path(self, number: int) -> str:
+        return os.path.join(self.directory, f"segment_{number:08d}.jsonl")
+
+    def _open_segment(self, number: int):
+        if self._active is not None:
+            self._active.close()
+        self._active = open(self._segment_path(number), "ab+")
+        self._active_size = self._active.seek(0, os.SEEK_END)
+        if self._active_size:
+            self._active.seek(-1, os.SEEK_END)
+            if self._active.read(1) != b"\n": # Последняя строка оборвана сбоем: новые записи начинаем с новой строки
+                self._active.write(b"\n")
+                self._active_size += 1
+        if number not in self._segments:
+            self._segments.append(number)
+
+    def _write(self, records: List[dict]) -> int:
+        if not records:
+            return 0
+        if self._active is None:
+            self._open_segment(self._segments[-1] if self._segments else 1)
+        elif self._active_size >= self.segment_max_bytes:
+            self._open_segment(self._segments[-1] + 1)
+        lines = [(json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8") for record in records]
+        data = b"".join(lines)
+        self._active.write(data)
+        self._active.flush()
+        if self.fsync:
+            os.fsync(self._active.fileno())
+        if self._index is not None:
+            offset = self._active_size
+            for record, line in zip(records, lines):
+                is_base = "b" in record
+                self._index_record(record["k"], record["t"], is_base, is_base and not record["b"] and "s" not in record,
+                                   "s" in record, self._segments[-1], offset, len(line))
+                offset += len(line)
+        self._active_size += len(data)
+        return len(data)
+
+    def flush(self) -> int:
+        """Дописывает накопленные записи в активный сегмент. Возвращает число записанных байт."""
+        with self._io_lock:
+            with self.lock:
+                records, self._pending = self._pending, []
+            try:
+                return self._write(records)
+            except Exception:
+                with self.lock: # Не теряем записи: вернем их в начало буфера
+                    self._pending[:0] = records
+                raise
+
+    def needs_compaction(self) -> bool:
+        return len(self._segments) > self.max_segments
+
+    def compact(self, snapshot: Dict[int, Tuple[List[str], float, Optional[str]]], expire_before: float = 0.0) -> int:
+        """Записывает базовые записи всех историй в новый сегмент и удаляет старые.
+
+        snapshot - {ключ: (реплики, время последней активности, краткое содержание)}, снятый под self.lock вместе с очисткой
+        буфера (см. take_snapshot), поэтому уже записанные в буфер изменения в нем учтены.
+        С индексом сюда же переносятся истории, выгруженные из памяти, кроме не обновлявшихся с expire_before.
+        """
+        with self._io_lock:
+            snapshot = dict(snapshot)
+            if self._index is not None:
+                for key, (ts, locations, summary_location) in list(self._index.items()):
+                    if key not in snapshot and ts >= expire_before:
+                        history, summary = self._read(locations, summary_location)
+                        snapshot[key] = (list(history), ts, summary)
+            old_segments = list(self._segments)
+            number = (old_segments[-1] if old_segments else 0) + 1
+            tmp_path = self._segment_path(number) + ".tmp"
+            index = {}
+            lines = []
+            offset = 0
+            for key, (entries, ts, summary) in snapshot.items():
+                if not entries and not summary:
+                    continue
+                record = {"k": key, "t": ts, "b": entries}
+                if summary:
+                    record["s"] = summary
+                line = (json.dumps(record, ensure_ascii=False) + "\n").encode("utf-8")
+                location = (number, offset, len(line))
+                index[key] = (ts, [location], location if summary else None)
+                lines.append(line)
+                offset += len(line)
+            data = b"".join(lines)
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+                f.flush()
+                if self.fsync:
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, self._segment_path(number))
+            if self._active is not None:
+                self._active.close()
+                self._active = None
+            self._segments = []
+            self._open_segment(number)
+            if self._index is not None:
+                self._index = index
+            for old in old_segments:
+                try:
+                    os.remove(self._segment_path(old))
+                except OSError as e:
+                    logger.warning(f"Failed to remove old history segment {old}: {e}")
+        logger.info(f"History log compacted: {len(lines)} histories, {len(data)} bytes, removed {len(old_segments)} segments.")
+        return len(data)
+
+    def take_snapshot(self, histories: Dict[int, Deque[str]], last_activity: Dict[int, float],
+                      summaries: Dict[int, str]) -> Dict[int, Tuple[List[str], float, Optional[str]]]:
+        """Снимок историй в памяти для compact; их записи в буфере при этом удаляются (они уже есть в историях).
+
+        Записи историй, выгруженных из памяти, остаются в буфере и попадут в журнал после уплотнения.
+        """
+        with self.lock:
+            self._pending = [record for record in self._pending if record["k"] not in histories]
+            return {key: (list(history), last_activity.get(key, time.time()), summaries.get(key))
+                    for key, history in list(histories.items())}
+
+    # --- Чтение при старте ---
+
+    def _list_segments(self):
+        os.makedirs(self.directory, exist_ok=True)
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"): # Незавершенное уплотнение
+                os.remove(os.path.join(self.directory, name))
+        self._segments = sorted(int(m.group(1)) for m in map(SEGMENT_RE.match, os.listdir(self.directory)) if m)
+
+    def replay(self, maxlen: int) -> Dict[int, Tuple[Deque[str], float, Optional[str]]]:
+        """Восстанавливает истории из сегментов: {ключ: (deque последних maxlen реплик, время последней записи, краткое содержание)}."""
+        self._list_segments()
+        histories: Dict[int, Tuple[Deque[str], float, Optional[str]]] = {}
+        bad_lines = 0
+        for number in self._segments:
+            with open(self._segment_path(number), "rb") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        key, ts = record["k"], record.get("t", 0.0)
+                        base = record["b"] if "b" in record else None
+                        entry = record["e"] if base is None else None
+                    except (ValueError, KeyError, TypeError): # Например, строка, оборванная сбоем при записи
+                        bad_lines += 1
+                        continue
+                    if base is not None:
+                        histories[key] = (deque(base, maxlen=maxlen), ts, record.get("s"))
+                    else:
+                        history, _, summary = histories[key] if key in histories else (deque(maxlen=maxlen), ts, None)
+                        history.append(entry)
+                        histories[key] = (history, ts, summary)
+        if bad_lines:
+            logger.warning(f"History log replay skipped {bad_lines} damaged lines.")
+        return {key: value for key, value in histories.items() if value[0] or value[2]}
+
+    # --- Ленивая загрузка ---
+
+    def _index_record(self, key: int, ts: float, is_base: bool, is_empty: bool, has_summary: bool,
+                      segment: int, offset: int, length: int):
+        if is_empty:
+            self._index.pop(key, None)
+            return
+        location = (segment, offset, length)
+        if is_base:
+            locations, summary_location = [], location if has_summary else None
+        else:
+            _, locations, summary_location = self._index.get(key, (ts, [], None))
+        locations.append(location)
+        if len(locations) > self._index_maxlen: # Последние maxlen добавлений полностью задают историю
+            del locations[:-self._index_maxlen]
+        self._index[key] = (ts, locations, summary_location)
+
+    def build_index(self, maxlen: int) -> int:
+        """Строит индекс вместо replay: читает сегменты, но разбирает только начало строк. Возвращает число историй."""
+        self._list_segments()
+        self._index, self._index_maxlen = {}, maxlen
+        bad_lines = 0
+        for number in self._segments:
+            offset = 0
+            with open(self._segment_path(number), "rb") as f:
+                for line in f:
+                    match = RECORD_HEAD_RE.match(line)
+                    try:
+                        if not match or not line.endswith(b"\n"):
+                            raise ValueError(line[:40])
+                        is_base = match.group(3) == b"b"
+                        # Внутри строк JSON кавычки экранированы, поэтому '], "s": ' встречается только как поле записи
+                        self._index_record(int(match.group(1)), float(match.group(2)), is_base,
+                                           is_base and line.startswith(b"[]}", match.end()),
+                                           is_base and b'], "s": ' in line, number, offset, len(line))
+                    except ValueError:
+                        bad_lines += 1
+                    offset += len(line)
+        if bad_lines:
+            logger.warning(f"History log index skipped {bad_lines} damaged lines.")
+        return len(self._index)
+
+    def _read(self, locations: List[Tuple[int, int, int]],
+              summary_location: Optional[Tuple[int, int, int]] = None) -> Tuple[Deque[str], Optional[str]]:
+        history: Deque[str] = deque(maxlen=self._index_maxlen)
+        summary = None
+        files = {}
+        try:
+            if summary_location is not None and summary_location not in locations:
+                number, offset, length = summary_location
+                files[number] = open(self._segment_path(number), "rb")
+                files[number].seek(offset)
+                try:
+                    summary = json.loads(files[number].read(length)).get("s")
+                except (ValueError, AttributeError):
+                    pass
+            for number, offset, length in locations:
+                if number not in files:
+                    files[number] = open(self._segment_path(number), "rb")
+                files[number].seek(offset)
+                try:
+                    record = json.loads(files[number].read(length))
+                    if "b" in record:
+                        history.clear()
+                        history.extend(record["b"])
+                        summary = record.get("s")
+                    else:
+                        history.append(record["e"])
+                except (ValueError, KeyError, TypeError):
+                    continue
+        finally:
+            for f in files.values():
+                f.close()
+        return history, summary
+
+    def load(self, key: int) -> Optional[Tuple[Deque[str], float, Optional[str]]]:
+        """История одного ключа по индексу, с учетом записей, еще не дошедших до диска. None - истории нет."""
+        with self._io_lock:
+            ts, locations, summary_location = self._index.get(key, (0.0, [], None))
+            history, summary = self._read(locations, summary_location)
+            with self.lock:
+                pending = [record for record in self._pending if record["k"] == key]
+        for record in pending:
+            if "b" in record:
+                history.clear()
+                history.extend(record["b"])
+                summary = record.get("s")
+            else:
+                history.append(record["e"])
+            ts = record["t"]
+        return (history, ts, summary) if history or summary else None
+
+    def close(self):
+        with self._io_lock: # Не закрываем файл посреди записи flush/compact
+            if self._active is not None:
+                self._active.close()
+                self._active = None
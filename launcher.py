@@ -0,0 +1,133 @@
+# launcher.py
+# Запуск нескольких экземпляров бота на одном хосте с общими весами моделей.
+# Модели загружаются один раз в родительском процессе, после чего он делает fork: дочерние процессы
+# делят страницы весов (copy-on-write), а не держат каждый свою копию RuBERT.
+#
+# Запуск: python launcher.py bots/masha bots/dasha [--report-interval 300]
+# Каждый каталог экземпляра содержит свой .env (TELEGRAM_BOT_TOKEN и т.д.); данные и bot.log экземпляра пишутся туда же.
+# Настройки моделей (INFERENCE_BACKEND, MODEL_CACHE_DIR, CONTEXT_EMBEDDINGS_ENABLED) берутся из .env каталога запуска.
+import argparse
+import gc
+import logging
+import os
+import signal
+import sys
+import time
+from logging.handlers import RotatingFileHandler
+
+import config
+from config import logger
+import metrics
+import utils
+
+# Имена из config, которые модули бота импортируют через "from config import ..."
+CONFIG_NAMES = ("TELEGRAM_BOT_TOKEN", "GEMINI_API_KEY", "ADMIN_USER_IDS", "MAX_HISTORY", "DEFAULT_STYLE", "BOT_NAME", "HISTORY_TTL")
+
+def _refresh_config_names():
+    """Обновляет копии значений config, уже импортированные модулями бота."""
+    for module in list(sys.modules.values()):
+        if module is None or module is config or not getattr(module, "__file__", None):
+            continue
+        if os.path.dirname(os.path.abspath(module.__file__)) != os.path.dirname(os.path.abspath(__file__)):
+            continue
+        for name in CONFIG_NAMES:
+            if hasattr(module, name):
+                setattr(module, name, getattr(config, name))
+
+def _reopen_log_file():
+    """Переводит файловый лог на bot.log в каталоге экземпляра."""
+    for handler in list(logger.handlers):
+        if isinstance(handler, RotatingFileHandler):
+            logger.removeHandler(handler)
+            handler.close()
+            file_handler = RotatingFileHandler('bot.log', maxBytes=5*1024*1024, backupCount=3, encoding='utf-8')
+            file_handler.setFormatter(handler.formatter)
+            logger.addHandler(file_handler)
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+def run_instance(instance_dir: str) -> int:
+    """Тело дочернего процесса: переключается на каталог экземпляра и запускает бота."""
+    os.chdir(instance_dir)
+    _reopen_log_file()
+    config.reload_env(os.path.join(".", ".env"))
+    _refresh_config_names()
+    utils.genai.configure(api_key=config.GEMINI_API_KEY)
+    # SIGTERM от лаунчера завершает polling так же, как Ctrl+C, с сохранением данных
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    logger.info(f"Worker {os.getpid()} started for {instance_dir}.")
+
+    import main
+    main.main()
+    return 0
+
+def log_workers_memory(workers):
+    for pid, instance_dir in workers.items():
+        memory = metrics.process_memory(pid)
+        if memory:
+            logger.info(f"Worker {pid} ({instance_dir}): USS {memory['uss']:.0f} MB, PSS {memory['pss']:.0f} MB, RSS {memory['rss']:.0f} MB")
+
+def main():
+    parser = argparse.ArgumentParser(description="Несколько экземпляров бота с общими весами моделей")
+    parser.add_argument("instances", nargs="+", help="каталоги экземпляров, в каждом свой .env")
+    parser.add_argument("--report-interval", type=int, default=300, help="период отчета о памяти воркеров, сек")
+    args = parser.parse_args()
+    if not hasattr(os, "fork"):
+        sys.exit("launcher.py requires os.fork (Linux/macOS).")
+
+    instance_dirs = [os.path.abspath(path) for path in args.instances]
+    for path in instance_dirs:
+        if not os.path.exists(os.path.join(path, ".env")):
+            sys.exit(f"{path}: .env not found.")
+
+    start = time.monotonic()
+    utils.preload_ml_pipelines()
+    # Объекты, созданные при загрузке, больше не обходятся сборщиком мусора и не копируются в дочерние процессы при записи
+    gc.freeze()
+    before = metrics.process_memory()
+    logger.info(f"Models loaded in {time.monotonic() - start:.1f}s before fork (RSS {before.get('rss', 0):.0f} MB).")
+
+    workers = {}
+    for path in instance_dirs:
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                code = run_instance(path)
+            except KeyboardInterrupt:
+                code = 0
+            except Exception as e:
+                logger.critical(f"Worker for {path} failed: {e}", exc_info=True)
+            finally:
+                logging.shutdown()
+                os._exit(code)
+        workers[pid] = path
+        logger.info(f"Started worker {pid} for {path}.")
+
+    def stop_workers(signum, frame):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    next_report = time.monotonic() + args.report_interval
+    try:
+        while workers:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid:
+                logger.info(f"Worker {pid} ({workers.pop(pid)}) exited with status {os.waitstatus_to_exitcode(status)}.")
+                continue
+            if time.monotonic() >= next_report:
+                log_workers_memory(workers)
+                next_report = time.monotonic() + args.report_interval
+            time.sleep(1)
+    except KeyboardInterrupt:
+        # Ctrl+C получает вся группа процессов; дожидаемся, пока воркеры сохранят данные
+        for pid in list(workers):
+            os.waitpid(pid, 0)
+
+if __name__ == "__main__":
+    main()
@@ -3,32 +3,68 @@ from datetime import timedelta
 
 from telegram import Update
 from telegram.ext import (ApplicationBuilder, CallbackContext, CallbackQueryHandler,
-                          CommandHandler, ContextTypes, MessageHandler, filters)
+                          CommandHandler, ContextTypes, MessageHandler, SimpleUpdateProcessor, TypeHandler, filters)
 
 # --- Импорт конфигурации ---
-from config import (ADMIN_USER_IDS, TELEGRAM_BOT_TOKEN, logger) # Оставляем только необходимое для main
+from config import (ADMIN_USER_IDS, TELEGRAM_BOT_TOKEN, logger, settings) # Оставляем только необходимое для main
 
 # --- Импорт состояния и функций управления им ---
-from state import load_all_data, save_all_data, cleanup_history_job # Импортируем функции работы с данными
+from state import (load_all_data, save_all_data, cleanup_history_job, persister, history_log, # Импортируем функции работы с данными
+                   evict_idle_job)
+from storage import get_storage
 
 # --- Импорт утилит ---
-from utils import cleanup_audio_files_job # Импортируем утилиты
+from utils import (cleanup_audio_files_job, warm_up_gemini, response_cache, # Импортируем утилиты
+                   summarize_histories_job, ensure_ml_warm_up)
+from metrics import log_metrics_job
 
 # --- Импорт обработчиков и команд ---
 from bot_commands import (ban_user_command, button_callback,
                           clear_history_command, clear_my_history_command,
                           error_handler, help_command, remember_command,
                           set_bot_name_command, set_default_style_command,
-                          set_my_name_command, start_command, set_activity_command, reset_context_command) # Добавили reset_context_command
+                          set_my_name_command, start_command, set_activity_command, reset_context_command, # Добавили reset_context_command
+                          stats_command, compact_storage_command)
 # ВАЖНО: Теперь main импортирует handlers, а handlers НЕ импортирует main
 from handlers import (handle_message, handle_photo, handle_video_note_message,
-                    handle_voice_message)
+                    handle_voice_message, load_update_state)
 
 
 # --- Настройка обработчиков и запуск бота ---
 
+class ChatOrderedUpdateProcessor(SimpleUpdateProcessor):
+    """Обрабатывает обновления разных чатов параллельно, а обновления одного чата - по очереди.
+
+    Параллельная обработка нужна пакетированию: проверки контекста и вызовы NER/тональности от разных чатов
+    собираются в один пакет. Очередь внутри чата сохраняет порядок реплик в истории.
+    """
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._chat_locks = {} # chat_id -> [asyncio.Lock, число ожидающих и выполняющихся обновлений]
+
+    async def do_process_update(self, update, coroutine):
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await coroutine
+            return
+        entry = self._chat_locks.setdefault(chat.id, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            # Ожидая своей очереди, обновление уже занимает один из CONCURRENT_UPDATES слотов
+            async with entry[0]:
+                await coroutine
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._chat_locks[chat.id]
+
+
 def setup_handlers(application):
     """Регистрирует все обработчики команд и сообщений."""
+    if settings.LAZY_LOADING:
+        # Группа -1 обрабатывает каждое обновление раньше остальных: данные пользователя подгружаются до команд и сообщений
+        application.add_handler(TypeHandler(Update, load_update_state), group=-1)
+
     # Команды пользователей
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("help", help_command))
@@ -53,16 +89,19 @@ def setup_handlers(application):
     application.add_handler(CommandHandler("set_default_style", set_default_style_command, filters=admin_filter))
     application.add_handler(CommandHandler("set_bot_name", set_bot_name_command, filters=admin_filter))
     application.add_handler(CommandHandler("set_activity", set_activity_command, filters=admin_filter)) # Регистрируем новую команду
+    application.add_handler(CommandHandler("stats", stats_command, filters=admin_filter))
+    application.add_handler(CommandHandler("compact_storage", compact_storage_command, filters=admin_filter))
 
     # Обработчик ошибок
     application.add_error_handler(error_handler)
     logger.info("All handlers registered.")
 
 async def save_all_data_job_wrapper(context: CallbackContext):
-    """Асинхронная обертка для сохранения данных из JobQueue."""
+    """Периодическое сохранение кэша ответов и выученных ответов JSON-хранилища (остальное состояние бота пишет
+    фоновый поток persister по мере изменений)."""
     logger.debug("Periodic save job triggered.")
-    # Запускаем синхронную функцию сохранения в отдельном потоке, чтобы не блокировать event loop
-    await asyncio.to_thread(save_all_data) # save_all_data импортирована из state.py
+    await asyncio.to_thread(save_all_data, learned=True)
+    await asyncio.to_thread(response_cache.save)
 
 def setup_jobs(application):
     """Регистрирует фоновые задачи."""
@@ -71,8 +110,21 @@ def setup_jobs(application):
     jq.run_repeating(cleanup_history_job, interval=timedelta(minutes=10), first=timedelta(seconds=10), name="cleanup_history")
     jq.run_repeating(cleanup_audio_files_job, interval=timedelta(hours=1), first=timedelta(seconds=60), name="cleanup_audio_files")
     jq.run_repeating(save_all_data_job_wrapper, interval=timedelta(minutes=30), first=timedelta(minutes=5), name="save_all_data")
+    jq.run_repeating(summarize_histories_job, interval=timedelta(seconds=settings.SUMMARY_INTERVAL), first=timedelta(seconds=30), name="summarize_histories")
+    jq.run_repeating(log_metrics_job, interval=timedelta(minutes=10), first=timedelta(minutes=10), name="log_metrics")
+    if settings.LAZY_LOADING:
+        jq.run_repeating(evict_idle_job, interval=timedelta(minutes=5), first=timedelta(minutes=5), name="evict_idle")
     logger.info("All jobs registered.")
 
+async def post_init(application):
+    """Запускается после инициализации приложения, до начала polling."""
+    if settings.GEMINI_WARMUP:
+        # Прогрев в фоне, чтобы не задерживать старт polling
+        application.create_task(warm_up_gemini())
+    if settings.ML_WARMUP:
+        # Модели загружаются в пуле инференса, пока бот уже принимает сообщения
+        ensure_ml_warm_up()
+
 # --- Точка входа ---
 def main():
     """Основная функция запуска бота."""
@@ -80,9 +132,14 @@ def main():
     try:
         # Загружаем данные перед созданием приложения
         load_all_data() # Импортирована из state.py
+        response_cache.load() # Теплый старт кэша ответов LLM
+        persister.start() # Изменения состояния сохраняются в фоне
 
         # Создаем приложение
-        application = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).build() # Токен из config.py
+        builder = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(post_init) # Токен из config.py
+        if settings.CONCURRENT_UPDATES > 1:
+            builder.concurrent_updates(ChatOrderedUpdateProcessor(settings.CONCURRENT_UPDATES))
+        application = builder.build()
 
         # Настраиваем обработчики и задачи
         setup_handlers(application)
@@ -95,8 +152,18 @@ def main():
         logger.critical(f"Critical error during bot startup or execution: {e}", exc_info=True)
     finally:
         logger.info("----- Bot Stopping -----")
-        # Сохраняем все данные перед выходом
-        save_all_data() # Импортирована из state.py
+        # Сохраняем все данные перед выходом: фоновый поток дописывает накопленные изменения не дольше дедлайна
+        if persister.running:
+            persister.stop(settings.PERSIST_SHUTDOWN_DEADLINE)
+        if not persister.running: # Не успевший остановиться поток еще пишет: не ждем его сверх дедлайна
+            save_all_data(learned=True) # Импортирована из state.py; дописывает и выученные ответы JSON-хранилища
+        response_cache.save()
+        if persister.running:
+            # Поток записи не уложился в дедлайн: не закрываем хранилище под ним, процесс завершится вместе с потоком
+            logger.warning("Persister is still writing, storage is left open.")
+        else:
+            history_log.close()
+            get_storage().close()
         logger.info("----- Bot Stopped -----")
 
 if __name__ == "__main__":
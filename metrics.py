@@ -0,0 +1,87 @@
+# metrics.py
+# Простые внутренние метрики бота: счетчики, значения (gauges) и наблюдения (латентности и т.п.).
+# Метрики периодически пишутся в лог и доступны администраторам через /stats.
+import os
+from collections import defaultdict
+from typing import Callable, Dict, List
+
+from config import logger
+
+counters: Dict[str, float] = defaultdict(float)
+gauges: Dict[str, float] = {}
+observations: Dict[str, Dict[str, float]] = {}
+_collectors: List[Callable[[], Dict[str, float]]] = []
+
+def inc(name: str, value: float = 1):
+    """Увеличивает счетчик."""
+    counters[name] += value
+
+def set_gauge(name: str, value: float):
+    """Устанавливает текущее значение метрики."""
+    gauges[name] = value
+
+def observe(name: str, value: float):
+    """Записывает наблюдение (например, латентность в секундах)."""
+    stats = observations.get(name)
+    if stats is None:
+        stats = observations[name] = {"count": 0, "sum": 0.0, "max": 0.0}
+    stats["count"] += 1
+    stats["sum"] += value
+    if value > stats["max"]:
+        stats["max"] = value
+
+def register_collector(collector: Callable[[], Dict[str, float]]):
+    """Регистрирует функцию, возвращающую значения метрик на момент вывода (например, статистику кэша)."""
+    _collectors.append(collector)
+
+def ratio(hits_name: str, total_names: tuple) -> float:
+    """Доля hits_name среди суммы счетчиков total_names."""
+    total = sum(counters.get(name, 0) for name in total_names)
+    return counters.get(hits_name, 0) / total if total else 0.0
+
+def format_metrics() -> str:
+    for collector in _collectors:
+        try:
+            gauges.update(collector())
+        except Exception as e:
+            logger.error(f"Metrics collector {collector} failed: {e}")
+    lines = []
+    for name in sorted(counters):
+        lines.append(f"{name} = {counters[name]:g}")
+    for name in sorted(gauges):
+        lines.append(f"{name} = {gauges[name]:g}")
+    for name in sorted(observations):
+        stats = observations[name]
+        avg = stats["sum"] / stats["count"] if stats["count"] else 0.0
+        lines.append(f"{name}: count={stats['count']:g} avg={avg:.3f} max={stats['max']:.3f}")
+    return "\n".join(lines) if lines else "Метрик пока нет."
+
+async def log_metrics_job(context):
+    """Периодическая задача, записывающая метрики в лог."""
+    logger.info(f"Metrics:\n{format_metrics()}")
+
+def process_memory(pid="self") -> Dict[str, float]:
+    """Память процесса в МБ по /proc/<pid>/smaps_rollup (Linux).
+
+    uss - страницы, принадлежащие только этому процессу (Private_Clean + Private_Dirty),
+    pss - с долей общих страниц, rss - всего. Пустой словарь, если данные недоступны.
+    """
+    path = f"/proc/{pid}/smaps_rollup"
+    if not os.path.exists(path):
+        return {}
+    values = {}
+    try:
+        with open(path, "r") as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == "kB":
+                    values[parts[0].rstrip(":")] = int(parts[1]) / 1024
+    except OSError:
+        return {}
+    return {
+        "uss": values.get("Private_Clean", 0.0) + values.get("Private_Dirty", 0.0),
+        "pss": values.get("Pss", 0.0),
+        "rss": values.get("Rss", 0.0),
+    }
+
+register_collector(lambda: {f"process.{name}_mb": value for name, value in process_memory().items()})
@@ -0,0 +1,138 @@
+# response_cache.py
+# Кэш ответов LLM с ограничением по объему, временем жизни записей и сохранением на диск.
+# Модуль не зависит от остального бота, поэтому его используют и main.py/utils.py, и chatbot.py.
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Примерные накладные расходы на одну запись (ключ, кортеж, узел OrderedDict)
+ENTRY_OVERHEAD_BYTES = 200
+
+
+class ResponseCache:
+    """LRU-кэш ответов LLM.
+
+    Ключ — SHA-256 промпта, поэтому сами (часто многокилобайтные) промпты в памяти не хранятся.
+    Объем ограничен max_bytes, записи устаревают через ttl секунд. Ответы-ошибки и
+    заблокированные ответы (строки вида "[...]") не кэшируются.
+    """
+
+    def __init__(self, max_bytes: int, ttl: float, path: Optional[str] = None, namespace: str = "",
+                 log: Optional[logging.Logger] = None):
+        self.logger = log or logger
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.namespace = namespace
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict() # key -> (ответ, время истечения)
+        self._size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def make_key(self, prompt) -> str:
+        return hashlib.sha256(f"{self.namespace}\x00{prompt}".encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def is_cacheable(response: Optional[str]) -> bool:
+        return bool(response) and not response.lstrip().startswith("[")
+
+    @staticmethod
+    def _entry_size(key: str, response: str) -> int:
+        return len(key) + len(response.encode("utf-8")) + ENTRY_OVERHEAD_BYTES
+
+    def get(self, prompt) -> Optional[str]:
+        key = self.make_key(prompt)
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        response, expires_at = entry
+        if expires_at <= time.time():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return response
+
+    def put(self, prompt, response: str):
+        if not self.is_cacheable(response):
+            return
+        self._store(self.make_key(prompt), response, time.time() + self.ttl)
+
+    def _store(self, key: str, response: str, expires_at: float):
+        size = self._entry_size(key, response)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (response, expires_at)
+        self._size += size
+        while self._size > self.max_bytes and self._entries:
+            oldest_key = next(iter(self._entries))
+            self._remove(oldest_key)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        response, _ = self._entries.pop(key)
+        self._size -= self._entry_size(key, response)
+
+    def clear(self):
+        self._entries.clear()
+        self._size = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def stats(self) -> Dict[str, float]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self._size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+    def load(self):
+        """Загружает непросроченные записи с диска (теплый старт)."""
+        if not self.path or not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            now = time.time()
+            loaded = 0
+            for key, response, expires_at in data.get("entries", []):
+                if expires_at > now:
+                    self._store(key, response, expires_at)
+                    loaded += 1
+            self.logger.info(f"Response cache loaded from {self.path}: {loaded} entries, {self._size} bytes.")
+        except Exception as e:
+            self.logger.error(f"Error loading response cache {self.path}: {e}", exc_info=True)
+
+    def save(self):
+        """Атомарно сохраняет непросроченные записи на диск (от старых к новым)."""
+        if not self.path:
+            return
+        now = time.time()
+        entries = [[key, response, expires_at] for key, (response, expires_at) in list(self._entries.items()) if expires_at > now]
+        tmp_path = f"{self.path}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump({"version": 1, "entries": entries}, f, ensure_ascii=False)
+            os.replace(tmp_path, self.path)
+            self.logger.info(f"Response cache saved to {self.path}: {len(entries)} entries.")
+        except Exception as e:
+            self.logger.error(f"Error saving response cache {self.path}: {e}", exc_info=True)
@@ -1,12 +1,15 @@
-import os
-import json
+import asyncio
+import threading
 import time
 from collections import deque
-from typing import Dict, Deque, Optional, Tuple
+from typing import Dict, Deque, Optional, Set, Tuple
 
 # Импортируем нужные константы и логгер из config
-from config import (logger, KNOWLEDGE_FILE, USER_DATA_DIR, MAX_HISTORY,
+from config import (logger, MAX_HISTORY, HISTORY_LOG_DIR,
                     USER_ROLE, ASSISTANT_ROLE, SYSTEM_ROLE, settings, HISTORY_TTL) # Добавили HISTORY_TTL
+from storage import get_storage, WriteBehindPersister
+from history_log import HistoryLog
+import metrics
 
 # --- Глобальное состояние бота ---
 user_preferred_name: Dict[int, str] = {}
@@ -15,22 +18,83 @@ learned_responses: Dict[str, str] = {}
 user_info_db: Dict[int, Dict[str, any]] = {}
 group_preferences: Dict[int, Dict[str, str]] = {}
 chat_history: Dict[int, Deque[str]] = {}
+chat_metadata: Dict[int, Dict[str, str]] = {} # Стиль и тема чата: хранятся отдельно от истории и выводятся в промпт один раз
+chat_summaries: Dict[int, str] = {} # Краткое содержание старой части диалога
+summary_candidates: Set[int] = set() # Ключи историй, которые пора сжать (обрабатываются фоновой задачей)
 last_activity: Dict[int, float] = {}
 feedback_data: Dict[int, Dict] = {} # Пока не используется
 group_user_style_prompts: Dict[Tuple[int, int], str] = {} # Пока не используется
 bot_activity_percentage: int = 100 # Добавляем процент активности бота
+dirty_keys: Set[int] = set() # Ключи пользователей/чатов, измененные после последнего сохранения
+resident_keys: Dict[int, float] = {} # LAZY_LOADING: ключи, загруженные в память, и время последнего обращения (monotonic)
+_knowledge_dirty = False # Изменены ли общие данные (настройки групп и т.п.), которые переписываются целиком
+learned_dirty: Set[str] = set() # Вопросы, ответы на которые выучены после последнего сохранения
+_saved_knowledge_settings: Optional[dict] = None # Настройки на момент последнего сохранения общих данных
+_save_lock = threading.Lock()
+# Истории всех чатов (и личных, и групповых) и их краткие содержания хранятся в журнале на дозапись, а не в записях пользователей
+history_log = HistoryLog(HISTORY_LOG_DIR, settings.HISTORY_SEGMENT_MAX_BYTES, settings.HISTORY_LOG_MAX_SEGMENTS,
+                         fsync=settings.STORAGE_FSYNC)
 
 # --- Функции управления состоянием ---
 
+def mark_dirty(key: int):
+    """Помечает данные пользователя/чата как измененные, чтобы их записал фоновый поток сохранения."""
+    dirty_keys.add(key)
+    persister.notify()
+
+def mark_knowledge_dirty():
+    """Помечает общие данные (настройки групп и т.п.) как измененные: они будут переписаны целиком."""
+    global _knowledge_dirty
+    _knowledge_dirty = True
+    persister.notify()
+
+def set_bot_activity_percentage(percentage: int):
+    """Меняет процент активности бота в группах и сохраняет его вместе с общими данными."""
+    global bot_activity_percentage
+    bot_activity_percentage = percentage
+    mark_knowledge_dirty()
+
+def mark_response_learned(question: str):
+    """Помечает выученный ответ: записывается только он, а не вся таблица выученных ответов."""
+    learned_dirty.add(question)
+    persister.notify()
+
 def add_to_history(key: int, role: str, message: str, user_name: Optional[str] = None):
     """Добавляет сообщение в историю чата и обновляет время активности."""
     if key not in chat_history:
         chat_history[key] = deque(maxlen=MAX_HISTORY)
     entry = f"{role} ({user_name}): {message}" if role == USER_ROLE and user_name else f"{role}: {message}"
-    chat_history[key].append(entry)
+    with history_log.lock:
+        chat_history[key].append(entry)
+        history_log.record_append(key, entry)
     last_activity[key] = time.time()
+    mark_dirty(key)
+    if len(chat_history[key]) >= settings.SUMMARY_TRIGGER_ENTRIES:
+        summary_candidates.add(key)
     logger.debug(f"History added for key {key}. Role: {role}. Message start: {message[:50]}...")
 
+def rebase_history(key: int):
+    """Записывает в журнал историю ключа целиком вместе с кратким содержанием. Вызывается после любых изменений,
+    кроме добавления реплики (очистка, сжатие в краткое содержание, удаление по неактивности)."""
+    with history_log.lock:
+        history_log.record_base(key, list(chat_history.get(key, ())), chat_summaries.get(key))
+    mark_dirty(key)
+
+# Фраза, которую содержал системный промпт, раньше добавлявшийся в историю на каждом ответе
+PER_TURN_SYSTEM_MARKER = "Не начинай свои ответы с приветствия"
+
+def set_chat_metadata(key: int, style: str, topic: str = ""):
+    """Запоминает актуальные стиль и тему чата (вместо добавления System-сообщения в историю)."""
+    metadata = {"style": style, "topic": topic}
+    if chat_metadata.get(key) != metadata: # Вызывается на каждое сообщение, поэтому помечаем только реальные изменения
+        chat_metadata[key] = metadata
+        mark_dirty(key)
+
+def _drop_per_turn_system_entries(history: list) -> list:
+    """Миграция: убирает из сохраненной истории дублирующиеся System-строки со стилем (заметки /remember остаются)."""
+    return [entry for entry in history
+            if not (entry.startswith(f"{SYSTEM_ROLE}:") and PER_TURN_SYSTEM_MARKER in entry)]
+
 async def cleanup_history_job(context): # Переименовано для ясности, что это job callback
     """Периодическая задача для удаления старой истории чатов."""
     # context тут не используется, но нужен для callback JobQueue
@@ -38,112 +102,214 @@ async def cleanup_history_job(context): # Переименовано для яс
     keys_to_delete = [key for key, ts in last_activity.items() if current_time - ts > HISTORY_TTL]
     deleted_count = 0
     for key in keys_to_delete:
-        if key in chat_history:
-            del chat_history[key]
+        if _forget_history(key):
             deleted_count +=1
-        if key in last_activity:
-            del last_activity[key]
-        # Можно удалять user_topic и т.д.
-        if key in user_topic: del user_topic[key]
 
     if deleted_count > 0:
         logger.info(f"Cleaned up history for {deleted_count} inactive chats/users.")
     else:
         logger.debug("History cleanup: No inactive chats found.")
 
-def load_all_data():
-    """Загружает общее состояние и данные пользователей при старте."""
-    global learned_responses, group_preferences, user_info_db, chat_history, settings, user_preferred_name, last_activity, user_topic, bot_activity_percentage
-    logger.info(f"Loading data from {KNOWLEDGE_FILE} and {USER_DATA_DIR}...")
+def clear_history(key: int):
+    """Сбрасывает историю чата вместе с ее кратким содержанием (команды очистки истории и сброса контекста)."""
+    chat_history.pop(key, None)
+    chat_summaries.pop(key, None)
+    summary_candidates.discard(key)
+    rebase_history(key)
 
-    # --- Загрузка общих данных ---
-    if os.path.exists(KNOWLEDGE_FILE):
-        try:
-            with open(KNOWLEDGE_FILE, "r", encoding="utf-8") as f:
-                data = json.load(f)
-                learned_responses = data.get("learned_responses", {})
-                group_preferences = data.get("group_preferences", {})
-                bot_settings_data = data.get("bot_settings")
-                if bot_settings_data:
-                    settings.MAX_HISTORY = bot_settings_data.get('MAX_HISTORY', settings.MAX_HISTORY)
-                    settings.DEFAULT_STYLE = bot_settings_data.get('DEFAULT_STYLE', settings.DEFAULT_STYLE)
-                    settings.BOT_NAME = bot_settings_data.get('BOT_NAME', settings.BOT_NAME)
-                    settings.HISTORY_TTL = bot_settings_data.get('HISTORY_TTL', settings.HISTORY_TTL)
-                    # Обновляем константы в config после загрузки
-                    import config
-                    config.MAX_HISTORY = settings.MAX_HISTORY
-                    config.DEFAULT_STYLE = settings.DEFAULT_STYLE
-                    config.BOT_NAME = settings.BOT_NAME
-                    config.HISTORY_TTL = settings.HISTORY_TTL
-                    logger.info("Bot settings loaded and applied from knowledge file.")
-                bot_activity_percentage = data.get("bot_activity_percentage", 100) # Загрузка процента активности
-        except Exception as e:
-             logger.error(f"Error loading {KNOWLEDGE_FILE}: {e}", exc_info=True)
-    else:
-        logger.warning(f"{KNOWLEDGE_FILE} not found.")
+def _forget_history(key: int) -> bool:
+    """Удаляет историю чата и связанные с ней данные. Возвращает True, если история была."""
+    deleted = False
+    if key in chat_history:
+        del chat_history[key]
+        deleted = True
+    if key in last_activity:
+        del last_activity[key]
+    # Можно удалять user_topic и т.д.
+    if key in user_topic: del user_topic[key]
+    if key in chat_metadata: del chat_metadata[key]
+    if key in chat_summaries: del chat_summaries[key]
+    rebase_history(key)
+    return deleted
 
-    # --- Загрузка данных пользователей ---
-    os.makedirs(USER_DATA_DIR, exist_ok=True)
-    loaded_user_count = 0
-    for filename in os.listdir(USER_DATA_DIR):
-        if filename.startswith("user_") and filename.endswith(".json"):
-            user_id_str = filename[len("user_"):-len(".json")]
-            if user_id_str.isdigit():
-                user_id = int(user_id_str)
-                user_file_path = os.path.join(USER_DATA_DIR, filename)
-                try:
-                    with open(user_file_path, "r", encoding="utf-8") as f:
-                        user_data = json.load(f)
-                        user_info_db[user_id] = user_data.get("info", {"preferences": {}})
-                        loaded_history = user_data.get('chat_history', [])
-                        if loaded_history:
-                            chat_history[user_id] = deque(loaded_history, maxlen=MAX_HISTORY)
-                        pref_name = user_data.get('preferred_name')
-                        if pref_name: user_preferred_name[user_id] = pref_name
-                        last_act = user_data.get('last_activity')
-                        if last_act: last_activity[user_id] = last_act
-                        topic = user_data.get('topic')
-                        if topic: user_topic[user_id] = topic
-                        loaded_user_count += 1
-                except Exception as e:
-                    logger.error(f"Error loading user data file {filename}: {e}", exc_info=True)
-            else:
-                 logger.warning(f"Skipping file with non-integer user ID: {filename}")
-    logger.info(f"Data loading complete. Loaded {loaded_user_count} user data files.")
+# --- Ленивая загрузка (LAZY_LOADING) ---
 
+def _read_key(key: int):
+    """Читает с диска запись пользователя и историю ключа (выполняется в потоке)."""
+    return get_storage().load_user(key), history_log.load(key)
 
-def save_user_data(user_id):
-    """Сохраняет данные конкретного пользователя в его файл."""
-    user_data_dir = os.path.join(".", USER_DATA_DIR)
-    os.makedirs(user_data_dir, exist_ok=True)
-    user_filename = f"user_{user_id}.json"
-    user_file_path = os.path.join(user_data_dir, user_filename)
+def _hydrate(key: int, record: Optional[dict], history: Optional[tuple]):
+    if history:
+        chat_history[key], last_activity[key], summary = history
+        if summary:
+            chat_summaries[key] = summary
+    if record:
+        _apply_user_record(key, record)
+    if key in last_activity and time.time() - last_activity[key] > settings.HISTORY_TTL:
+        _forget_history(key) # То же, что сделала бы cleanup_history_job, будь ключ в памяти
+
+async def ensure_loaded(key: int):
+    """Подгружает данные пользователя или группового чата при первом обращении. Без LAZY_LOADING ничего не делает."""
+    if not settings.LAZY_LOADING:
+        return
+    if key not in resident_keys:
+        start = time.monotonic()
+        record, history = await asyncio.to_thread(_read_key, key)
+        if key not in resident_keys: # Пока шло чтение, ключ мог загрузить другой обработчик
+            _hydrate(key, record, history)
+        metrics.observe("state.hydrate.duration", time.monotonic() - start)
+    resident_keys[key] = time.monotonic()
+    metrics.set_gauge("state.resident_keys", len(resident_keys))
+
+def _evict(key: int):
+    """Убирает из памяти данные ключа (все они уже записаны на диск)."""
+    del resident_keys[key]
+    summary_candidates.discard(key)
+    chat_history.pop(key, None) # История и краткое содержание есть в журнале
+    chat_summaries.pop(key, None)
+    last_activity.pop(key, None)
+    if key in user_info_db: # Остальное сохраняется только в записях пользователей, у групп оно остается в памяти
+        del user_info_db[key]
+        for data in (user_preferred_name, user_topic, chat_metadata):
+            data.pop(key, None)
+
+async def evict_idle_job(context):
+    """Периодическая задача: выгружает из памяти пользователей и чаты, к которым давно не обращались."""
+    if not _save_lock.acquire(blocking=False): # Идет сохранение - выгрузим в следующий раз
+        return
+    try:
+        now = time.monotonic()
+        # Несохраненные изменения ждут фоновой записи
+        idle = [key for key, ts in resident_keys.items() if now - ts > settings.EVICT_IDLE_AFTER and key not in dirty_keys]
+        for key in idle:
+            _evict(key)
+    finally:
+        _save_lock.release()
+    metrics.set_gauge("state.resident_keys", len(resident_keys))
+    if idle:
+        logger.info(f"Evicted {len(idle)} idle users/chats from memory, {len(resident_keys)} remain loaded.")
+
+def _apply_user_record(user_id: int, user_data: dict) -> int:
+    """Раскладывает запись пользователя из хранилища по структурам состояния. Возвращает число удаленных при миграции строк."""
+    user_info_db[user_id] = user_data.get("info", {"preferences": {}})
+    # История и краткое содержание в записи пользователя - прежний формат: берем их, только если журнал их не знает,
+    # и переносим в журнал
+    loaded_history = user_data.get('chat_history', []) if user_id not in chat_history else []
+    migrated_history = _drop_per_turn_system_entries(loaded_history)
+    if migrated_history:
+        chat_history[user_id] = deque(migrated_history, maxlen=MAX_HISTORY)
+    summary = user_data.get('summary') if user_id not in chat_summaries else None
+    if summary:
+        chat_summaries[user_id] = summary
+    if migrated_history or summary:
+        with history_log.lock:
+            history_log.record_base(user_id, list(chat_history.get(user_id, ())), chat_summaries.get(user_id))
+        dirty_keys.add(user_id) # Перезаписать запись уже без них
+    pref_name = user_data.get('preferred_name')
+    if pref_name: user_preferred_name[user_id] = pref_name
+    last_act = user_data.get('last_activity')
+    if last_act: last_activity[user_id] = last_act
+    topic = user_data.get('topic')
+    if topic: user_topic[user_id] = topic
+    chat_meta = user_data.get('chat_meta')
+    if chat_meta: chat_metadata[user_id] = chat_meta
+    return len(loaded_history) - len(migrated_history)
 
+def _user_record(user_id: int) -> dict:
+    """Запись пользователя для хранилища (пустые поля опускаются)."""
     data_to_save = {
         "info": user_info_db.get(user_id, {}),
-        "chat_history": list(chat_history.get(user_id, [])),
         "preferred_name": user_preferred_name.get(user_id),
         "last_activity": last_activity.get(user_id),
-        "topic": user_topic.get(user_id)
+        "topic": user_topic.get(user_id),
+        "chat_meta": chat_metadata.get(user_id),
     }
-    data_to_save = {k: v for k, v in data_to_save.items() if v is not None}
+    return {k: v for k, v in data_to_save.items() if v is not None}
 
+def load_all_data():
+    """Загружает общее состояние и данные пользователей при старте."""
+    # Словари обновляются на месте: другие модули импортировали их по имени
+    global bot_activity_percentage, _saved_knowledge_settings
+    storage = get_storage()
+    logger.info(f"Loading data from {settings.STORAGE_BACKEND} storage...")
+
+    # --- Загрузка общих данных ---
     try:
-        with open(user_file_path, "w", encoding="utf-8") as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=4)
-        logger.debug(f"User data saved for user_id: {user_id}")
+        data = storage.load_knowledge()
+        if data:
+            learned_responses.clear()
+            learned_responses.update(data.get("learned_responses", {}))
+            group_preferences.clear()
+            group_preferences.update(data.get("group_preferences", {}))
+            bot_settings_data = data.get("bot_settings")
+            if bot_settings_data:
+                settings.MAX_HISTORY = bot_settings_data.get('MAX_HISTORY', settings.MAX_HISTORY)
+                settings.DEFAULT_STYLE = bot_settings_data.get('DEFAULT_STYLE', settings.DEFAULT_STYLE)
+                settings.BOT_NAME = bot_settings_data.get('BOT_NAME', settings.BOT_NAME)
+                settings.HISTORY_TTL = bot_settings_data.get('HISTORY_TTL', settings.HISTORY_TTL)
+                # Обновляем константы в config после загрузки
+                import config
+                config.MAX_HISTORY = settings.MAX_HISTORY
+                config.DEFAULT_STYLE = settings.DEFAULT_STYLE
+                config.BOT_NAME = settings.BOT_NAME
+                config.HISTORY_TTL = settings.HISTORY_TTL
+                logger.info("Bot settings loaded and applied from storage.")
+            bot_activity_percentage = data.get("bot_activity_percentage", 100) # Загрузка процента активности
+            _saved_knowledge_settings = _knowledge_settings()
     except Exception as e:
-        logger.error(f"Error saving user data for {user_id} to {user_filename}: {e}", exc_info=True)
+        logger.error(f"Error loading common data: {e}", exc_info=True)
 
+    # --- Ленивая загрузка: только индекс журнала, остальное при первом обращении (ensure_loaded) ---
+    if settings.LAZY_LOADING:
+        try:
+            start = time.monotonic()
+            indexed = history_log.build_index(MAX_HISTORY)
+            logger.info(f"Data loading complete (lazy): indexed {indexed} chat histories in {time.monotonic() - start:.2f}s.")
+        except Exception as e:
+            logger.error(f"Error indexing history log: {e}", exc_info=True)
+        return
 
-def save_all_data():
-    """Сохраняет все данные (общие и пользовательские) при остановке бота."""
-    logger.info("Saving all data...")
+    # --- Загрузка историй из журнала ---
+    try:
+        start = time.monotonic()
+        replayed = history_log.replay(MAX_HISTORY)
+        for key, (history, last_ts, summary) in replayed.items():
+            chat_history[key] = history
+            last_activity[key] = last_ts # Для пользователей уточняется ниже из их записей
+            if summary:
+                chat_summaries[key] = summary
+        logger.info(f"Replayed {len(replayed)} chat histories from {HISTORY_LOG_DIR} in {time.monotonic() - start:.2f}s.")
+    except Exception as e:
+        logger.error(f"Error replaying history log: {e}", exc_info=True)
 
-    # --- Сохранение общих данных ---
-    knowledge_data = {
-        "learned_responses": learned_responses,
-        "group_preferences": group_preferences,
+    # --- Загрузка данных пользователей ---
+    loaded_user_count = 0
+    migrated_entries_count = 0
+    try:
+        for user_id, user_data in storage.load_users():
+            try:
+                migrated_entries_count += _apply_user_record(user_id, user_data)
+                loaded_user_count += 1
+            except Exception as e:
+                logger.error(f"Error applying stored data for user {user_id}: {e}", exc_info=True)
+    except Exception as e:
+        logger.error(f"Error loading user data: {e}", exc_info=True)
+    if migrated_entries_count:
+        logger.info(f"Migration: dropped {migrated_entries_count} duplicated per-turn System entries from stored histories.")
+    logger.info(f"Data loading complete. Loaded {loaded_user_count} users.")
+
+
+def save_user_data(user_id):
+    """Сохраняет данные конкретного пользователя."""
+    try:
+        get_storage().save_users({user_id: _user_record(user_id)})
+        dirty_keys.discard(user_id)
+    except Exception as e:
+        logger.error(f"Error saving user data for {user_id}: {e}", exc_info=True)
+
+
+def _knowledge_settings() -> dict:
+    return {
         "bot_settings": {
             "MAX_HISTORY": settings.MAX_HISTORY,
             "DEFAULT_STYLE": settings.DEFAULT_STYLE,
@@ -152,18 +318,84 @@ def save_all_data():
         },
         "bot_activity_percentage": bot_activity_percentage, # Сохраняем процент активности
     }
+
+def save_all_data(full: bool = False, learned: bool = False):
+    """Сохраняет данные.
+
+    По умолчанию записывает только пользователей и общие данные, измененные после прошлого сохранения.
+    full=True переписывает все целиком (используется при уплотнении хранилища).
+    learned=True записывает новые выученные ответы и там, где это возможно только перезаписью всех общих данных
+    (JSON): это делают периодическая задача и остановка бота, а не фоновый поток на каждое изменение.
+    """
+    with _save_lock: # Фоновый поток и /compact_storage не пишут одновременно
+        _save_all_data(full, learned)
+
+def _save_all_data(full: bool, learned: bool = False):
+    global _knowledge_dirty, _saved_knowledge_settings
+    mode = "full" if full else "incremental"
+    logger.debug(f"Saving data ({mode})...")
+    storage = get_storage()
+    start = time.monotonic()
+    bytes_written = 0
+
+    # --- Журнал историй (до записей пользователей, которые историю больше не содержат) ---
+    try:
+        bytes_written += history_log.flush()
+        if full or history_log.needs_compaction():
+            bytes_written += history_log.compact(history_log.take_snapshot(chat_history, last_activity, chat_summaries),
+                                                 expire_before=time.time() - settings.HISTORY_TTL)
+    except Exception as e:
+        logger.error(f"Error writing history log: {e}", exc_info=True)
+
+    # --- Сохранение общих данных ---
+    knowledge_settings = _knowledge_settings()
+    rewrite_knowledge = full or _knowledge_dirty or knowledge_settings != _saved_knowledge_settings
+    if learned_dirty and learned and not storage.upserts_learned_responses:
+        rewrite_knowledge = True
+    questions = set(learned_dirty)
+    learned_dirty.difference_update(questions)
+    if rewrite_knowledge:
+        _knowledge_dirty = False
+        knowledge_data = {"learned_responses": dict(learned_responses), "group_preferences": dict(group_preferences)}
+        knowledge_data.update(knowledge_settings)
+        try:
+            bytes_written += storage.save_knowledge(knowledge_data)
+            _saved_knowledge_settings = knowledge_settings
+        except Exception as e:
+            _knowledge_dirty = True
+            learned_dirty.update(questions)
+            logger.error(f"Error saving common data: {e}", exc_info=True)
+    elif questions and storage.upserts_learned_responses:
+        try:
+            bytes_written += storage.save_learned_responses(
+                {question: learned_responses[question] for question in questions if question in learned_responses})
+        except Exception as e:
+            learned_dirty.update(questions)
+            logger.error(f"Error saving learned responses: {e}", exc_info=True)
+    else:
+        learned_dirty.update(questions) # Дождутся перезаписи общих данных
+
+    # --- Сохранение данных пользователей ---
+    # Флаги снимаются до снятия снимка: изменения, сделанные во время записи, попадут в следующее сохранение
+    keys = set(user_info_db.keys()) if full else set(dirty_keys)
+    dirty_keys.difference_update(keys)
+    user_ids = [key for key in keys if key in user_info_db] # У групп записи нет: их истории и краткие содержания - в журнале
     try:
-        with open(KNOWLEDGE_FILE, "w", encoding="utf-8") as f:
-            json.dump(knowledge_data, f, ensure_ascii=False, indent=4)
-        logger.info(f"Knowledge file saved: {KNOWLEDGE_FILE}")
+        bytes_written += storage.save_users({user_id: _user_record(user_id) for user_id in user_ids})
     except Exception as e:
-         logger.error(f"Error saving knowledge file {KNOWLEDGE_FILE}: {e}", exc_info=True)
+        dirty_keys.update(user_ids)
+        logger.error(f"Error saving user data: {e}", exc_info=True)
+
+    duration = time.monotonic() - start
+    metrics.inc("storage.bytes_written", bytes_written)
+    metrics.observe(f"storage.save.{mode}.duration", duration)
+    if bytes_written or full:
+        logger.info(f"Data saving complete ({mode}): {len(user_ids)} users, {bytes_written} bytes written in {duration:.2f}s.")
 
-    # --- Сохранение данных всех активных пользователей ---
-    saved_user_count = 0
-    active_user_ids = list(user_info_db.keys()) # Копируем ключи, чтобы избежать ошибок при изменении словаря
-    for user_id in active_user_ids:
-        save_user_data(user_id)
-        saved_user_count += 1
+def compact_data():
+    """Полная перезапись всех данных и уплотнение хранилища."""
+    save_all_data(full=True)
+    get_storage().compact()
 
-    logger.info(f"All data saving complete. Saved data for {saved_user_count} users.")
+# Фоновая запись изменений (запускается в main после загрузки данных)
+persister = WriteBehindPersister(save_all_data, settings.PERSIST_DELAY)
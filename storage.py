@@ -0,0 +1,441 @@
+# storage.py
+# Слой хранения состояния бота. state.py читает и пишет только через него, формат на диске выбирается настройкой
+# STORAGE_BACKEND: "json" (learned_knowledge.json + user_data/user_<id>.json) или "sqlite" (одна база в режиме WAL).
+#
+# Обмен идет двумя видами записей:
+#   knowledge - общие данные: {"learned_responses", "group_preferences", "bot_settings", "bot_activity_percentage"}
+#   user record - данные одного пользователя: {"info", "chat_history", "preferred_name", "last_activity",
+#                 "topic", "chat_meta", "summary"} (пустые поля опускаются)
+#
+# Однократный перенос данных из JSON в SQLite: python storage.py migrate
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from typing import Callable, Dict, Iterator, Optional, Tuple
+
+from config import logger, KNOWLEDGE_FILE, USER_DATA_DIR, DATABASE_FILE, settings
+
+def _dumps(value) -> Optional[str]:
+    return json.dumps(value, ensure_ascii=False) if value is not None else None
+
+def atomic_write(path: str, data: bytes, fsync: bool = False):
+    """Пишет файл целиком или не трогает его: запись во временный файл рядом и os.replace.
+
+    При fsync=True данные и запись в каталоге сбрасываются на диск (переживает и сбой питания).
+    """
+    directory = os.path.dirname(path) or "."
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+    if fsync and hasattr(os, "O_DIRECTORY"):
+        dir_fd = os.open(directory, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+
+
+class Storage:
+    """Интерфейс хранилища."""
+
+    # Может ли хранилище дописывать отдельные выученные ответы (save_learned_responses), не переписывая все общие данные
+    upserts_learned_responses = False
+
+    def load_knowledge(self) -> Optional[dict]:
+        raise NotImplementedError
+
+    def save_knowledge(self, knowledge: dict) -> int:
+        """Записывает общие данные. Возвращает примерный объем записанного в байтах."""
+        raise NotImplementedError
+
+    def save_learned_responses(self, responses: Dict[str, str]) -> int:
+        """Добавляет или заменяет выученные ответы. Возвращает примерный объем записанного в байтах."""
+        raise NotImplementedError
+
+    def load_users(self) -> Iterator[Tuple[int, dict]]:
+        raise NotImplementedError
+
+    def load_user(self, user_id: int) -> Optional[dict]:
+        """Запись одного пользователя (ленивая загрузка). None - пользователя нет."""
+        raise NotImplementedError
+
+    def save_users(self, records: Dict[int, dict]) -> int:
+        """Записывает (заменяет) записи пользователей. Возвращает примерный объем записанного в байтах."""
+        raise NotImplementedError
+
+    def compact(self):
+        """Освобождает место, занятое устаревшими данными."""
+        pass
+
+    def close(self):
+        pass
+
+
+class JsonStorage(Storage):
+    """Прежний формат: общий JSON-файл и по файлу на пользователя."""
+
+    def __init__(self, knowledge_file: str = KNOWLEDGE_FILE, user_data_dir: str = USER_DATA_DIR, fsync: bool = False):
+        self.knowledge_file = knowledge_file
+        self.user_data_dir = user_data_dir
+        self.fsync = fsync
+
+    def load_knowledge(self) -> Optional[dict]:
+        if not os.path.exists(self.knowledge_file):
+            logger.warning(f"{self.knowledge_file} not found.")
+            return None
+        with open(self.knowledge_file, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def save_knowledge(self, knowledge: dict) -> int:
+        data = json.dumps(knowledge, ensure_ascii=False, indent=4).encode("utf-8")
+        atomic_write(self.knowledge_file, data, self.fsync)
+        logger.info(f"Knowledge file saved: {self.knowledge_file}")
+        return len(data)
+
+    def load_users(self) -> Iterator[Tuple[int, dict]]:
+        os.makedirs(self.user_data_dir, exist_ok=True)
+        for filename in os.listdir(self.user_data_dir):
+            if not (filename.startswith("user_") and filename.endswith(".json")):
+                continue
+            user_id_str = filename[len("user_"):-len(".json")]
+            if not user_id_str.isdigit():
+                logger.warning(f"Skipping file with non-integer user ID: {filename}")
+                continue
+            try:
+                with open(os.path.join(self.user_data_dir, filename), "r", encoding="utf-8") as f:
+                    yield int(user_id_str), json.load(f)
+            except Exception as e:
+                logger.error(f"Error loading user data file {filename}: {e}", exc_info=True)
+
+    def load_user(self, user_id: int) -> Optional[dict]:
+        try:
+            with open(os.path.join(self.user_data_dir, f"user_{user_id}.json"), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return None
+
+    def save_users(self, records: Dict[int, dict]) -> int:
+        os.makedirs(self.user_data_dir, exist_ok=True)
+        bytes_written = 0
+        for user_id, record in records.items():
+            user_filename = f"user_{user_id}.json"
+            try:
+                data = json.dumps(record, ensure_ascii=False, indent=4).encode("utf-8")
+                atomic_write(os.path.join(self.user_data_dir, user_filename), data, self.fsync)
+                bytes_written += len(data)
+                logger.debug(f"User data saved for user_id: {user_id}")
+            except Exception as e:
+                logger.error(f"Error saving user data for {user_id} to {user_filename}: {e}", exc_info=True)
+        return bytes_written
+
+
+class SqliteStorage(Storage):
+    """SQLite в режиме WAL: пользователи, настройки групп и выученные ответы в отдельных таблицах.
+
+    Соединение одно на процесс и используется из разных потоков (сохранение идет через asyncio.to_thread),
+    поэтому все обращения к нему идут под блокировкой.
+    """
+
+    upserts_learned_responses = True
+
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS users (
+        user_id INTEGER PRIMARY KEY,
+        info TEXT,
+        preferred_name TEXT,
+        last_activity REAL,
+        topic TEXT,
+        chat_meta TEXT
+    );
+    CREATE INDEX IF NOT EXISTS users_last_activity ON users(last_activity);
+    CREATE TABLE IF NOT EXISTS group_preferences (
+        chat_id TEXT PRIMARY KEY,
+        data TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS learned_responses (
+        question TEXT PRIMARY KEY,
+        answer TEXT NOT NULL
+    );
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT NOT NULL
+    );
+    """
+    # Истории и краткие содержания теперь живут в журнале историй. Базы прежнего формата хранят их здесь:
+    # они читаются только для переноса в журнал, а при перезаписи пользователя удаляются
+    LEGACY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS history_entries (
+        history_key INTEGER NOT NULL,
+        position INTEGER NOT NULL,
+        entry TEXT NOT NULL,
+        PRIMARY KEY (history_key, position)
+    ) WITHOUT ROWID;
+    """
+
+    def __init__(self, path: str = DATABASE_FILE, fsync: bool = False):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # NORMAL в WAL не портит базу при сбое, но последняя транзакция может потеряться при отключении питания; FULL - fsync на каждый коммит
+        self._conn.execute(f"PRAGMA synchronous={'FULL' if fsync else 'NORMAL'}")
+        self._conn.executescript(self.SCHEMA)
+        self._conn.commit()
+        self._legacy_history = self._conn.execute(
+            "SELECT EXISTS(SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_entries')").fetchone()[0]
+        self._legacy_summary = any(column[1] == "summary" for column in self._conn.execute("PRAGMA table_info(users)"))
+
+    def _ensure_legacy_schema(self):
+        """Создает таблицу историй и колонку summary для записей прежнего формата (перенос из JSON). Вызывается под _lock."""
+        if not self._legacy_history:
+            self._conn.executescript(self.LEGACY_SCHEMA)
+            self._legacy_history = True
+        if not self._legacy_summary:
+            self._conn.execute("ALTER TABLE users ADD COLUMN summary TEXT")
+            self._legacy_summary = True
+
+    def _user_columns(self) -> str:
+        return "info, preferred_name, last_activity, topic, chat_meta" + (", summary" if self._legacy_summary else "")
+
+    def is_empty(self) -> bool:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT EXISTS(SELECT 1 FROM users) OR EXISTS(SELECT 1 FROM meta) OR EXISTS(SELECT 1 FROM learned_responses)"
+            ).fetchone()
+        return not row[0]
+
+    def load_knowledge(self) -> Optional[dict]:
+        with self._lock:
+            meta = dict(self._conn.execute("SELECT key, value FROM meta"))
+            learned = dict(self._conn.execute("SELECT question, answer FROM learned_responses"))
+            groups = {chat_id: json.loads(data) for chat_id, data in self._conn.execute("SELECT chat_id, data FROM group_preferences")}
+        if not meta and not learned and not groups:
+            return None
+        knowledge = {"learned_responses": learned, "group_preferences": groups}
+        knowledge.update({key: json.loads(value) for key, value in meta.items()})
+        return knowledge
+
+    def save_knowledge(self, knowledge: dict) -> int:
+        learned = list(knowledge.get("learned_responses", {}).items())
+        groups = [(str(chat_id), _dumps(data)) for chat_id, data in knowledge.get("group_preferences", {}).items()]
+        meta = [(key, json.dumps(value, ensure_ascii=False)) for key, value in knowledge.items()
+                if key not in ("learned_responses", "group_preferences")]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM learned_responses")
+            self._conn.executemany("INSERT INTO learned_responses (question, answer) VALUES (?, ?)", learned)
+            self._conn.execute("DELETE FROM group_preferences")
+            self._conn.executemany("INSERT INTO group_preferences (chat_id, data) VALUES (?, ?)", groups)
+            self._conn.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", meta)
+        logger.info(f"Knowledge saved to {self.path}")
+        return sum(len(a.encode("utf-8")) + len(b.encode("utf-8")) for a, b in learned + groups + meta)
+
+    def save_learned_responses(self, responses: Dict[str, str]) -> int:
+        with self._lock, self._conn:
+            self._conn.executemany("INSERT OR REPLACE INTO learned_responses (question, answer) VALUES (?, ?)",
+                                   list(responses.items()))
+        logger.debug(f"Saved {len(responses)} learned responses to {self.path}")
+        return sum(len(q.encode("utf-8")) + len(a.encode("utf-8")) for q, a in responses.items())
+
+    def load_users(self) -> Iterator[Tuple[int, dict]]:
+        with self._lock:
+            user_rows = self._conn.execute(f"SELECT user_id, {self._user_columns()} FROM users").fetchall()
+            history_rows = self._conn.execute(
+                "SELECT history_key, entry FROM history_entries ORDER BY history_key, position").fetchall() if self._legacy_history else []
+        histories: Dict[int, list] = {}
+        for history_key, entry in history_rows:
+            histories.setdefault(history_key, []).append(entry)
+        for user_id, info, preferred_name, last_activity, topic, chat_meta, *legacy in user_rows:
+            summary = legacy[0] if legacy else None
+            record = {
+                "info": json.loads(info) if info else None,
+                "chat_history": histories.pop(user_id, None),
+                "preferred_name": preferred_name,
+                "last_activity": last_activity,
+                "topic": topic,
+                "chat_meta": json.loads(chat_meta) if chat_meta else None,
+                "summary": summary,
+            }
+            yield user_id, {k: v for k, v in record.items() if v is not None}
+        for history_key, entries in histories.items(): # История без строки в users
+            yield history_key, {"chat_history": entries}
+
+    def load_user(self, user_id: int) -> Optional[dict]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {self._user_columns()} FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            history = [entry for (entry,) in self._conn.execute(
+                "SELECT entry FROM history_entries WHERE history_key = ? ORDER BY position", (user_id,))] if self._legacy_history else []
+        if row is None and not history:
+            return None
+        info, preferred_name, last_activity, topic, chat_meta, *legacy = row or (None,) * 5
+        summary = legacy[0] if legacy else None
+        record = {
+            "info": json.loads(info) if info else None,
+            "chat_history": history or None,
+            "preferred_name": preferred_name,
+            "last_activity": last_activity,
+            "topic": topic,
+            "chat_meta": json.loads(chat_meta) if chat_meta else None,
+            "summary": summary,
+        }
+        return {k: v for k, v in record.items() if v is not None}
+
+    def save_users(self, records: Dict[int, dict]) -> int:
+        bytes_written = 0
+        with self._lock, self._conn:
+            if any("chat_history" in record or "summary" in record for record in records.values()):
+                self._ensure_legacy_schema()
+            for user_id, record in records.items():
+                row = (user_id, _dumps(record.get("info")), record.get("preferred_name"), record.get("last_activity"),
+                       record.get("topic"), _dumps(record.get("chat_meta")))
+                if self._legacy_summary: # Без summary в записи колонка обнуляется: краткое содержание уже в журнале
+                    row += (record.get("summary"),)
+                self._conn.execute(
+                    f"INSERT OR REPLACE INTO users (user_id, {self._user_columns()}) VALUES ({', '.join('?' * len(row))})", row)
+                history = record.get("chat_history", [])
+                if self._legacy_history:
+                    self._conn.execute("DELETE FROM history_entries WHERE history_key = ?", (user_id,))
+                    self._conn.executemany("INSERT INTO history_entries (history_key, position, entry) VALUES (?, ?, ?)",
+                                           ((user_id, position, entry) for position, entry in enumerate(history)))
+                bytes_written += sum(len(value.encode("utf-8")) for value in row[1:] if isinstance(value, str))
+                bytes_written += sum(len(entry.encode("utf-8")) for entry in history)
+        logger.debug(f"Saved {len(records)} user records to {self.path}")
+        return bytes_written
+
+    def compact(self):
+        """Переносит WAL в основной файл и пересобирает базу без свободных страниц."""
+        with self._lock:
+            if self._legacy_history and not self._conn.execute("SELECT EXISTS(SELECT 1 FROM history_entries)").fetchone()[0]:
+                with self._conn: # Все истории уже перенесены в журнал
+                    self._conn.execute("DROP TABLE history_entries")
+                self._legacy_history = False
+            self._conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._conn.execute("VACUUM")
+        logger.info(f"SQLite storage {self.path} compacted ({os.path.getsize(self.path)} bytes).")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+_storage: Optional[Storage] = None
+
+def get_storage() -> Storage:
+    """Хранилище, выбранное настройкой STORAGE_BACKEND."""
+    global _storage
+    if _storage is None:
+        if settings.STORAGE_BACKEND == "sqlite":
+            _storage = SqliteStorage(DATABASE_FILE, fsync=settings.STORAGE_FSYNC)
+            if _storage.is_empty() and (os.path.exists(KNOWLEDGE_FILE) or os.path.isdir(USER_DATA_DIR)):
+                logger.info(f"{DATABASE_FILE} is empty, migrating existing JSON data into it.")
+                migrate_json_to_sqlite(JsonStorage(), _storage)
+        else:
+            _storage = JsonStorage(fsync=settings.STORAGE_FSYNC)
+    return _storage
+
+
+class WriteBehindPersister:
+    """Фоновый поток записи.
+
+    Изменения состояния только помечаются (notify), а единственный поток записи дает им накопиться
+    delay секунд и сохраняет одной пачкой через flush. Так обработчики не ждут диска, а частые
+    изменения одного пользователя записываются один раз.
+    """
+
+    def __init__(self, flush: Callable[[], None], delay: float):
+        self._flush = flush
+        self.delay = delay
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self):
+        if self.running:
+            return
+        self._stopping.clear()
+        self._thread = threading.Thread(target=self._run, name="persister", daemon=True)
+        self._thread.start()
+        logger.info(f"Write-behind persister started (delay {self.delay}s).")
+
+    def notify(self):
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait()
+            # Даем изменениям накопиться; остановка прерывает ожидание сразу
+            self._stopping.wait(self.delay)
+            self._wakeup.clear()
+            self._safe_flush()
+        self._safe_flush() # Финальная запись того, что изменилось после последней пачки
+
+    def _safe_flush(self):
+        try:
+            self._flush()
+        except Exception as e:
+            logger.error(f"Write-behind flush failed: {e}", exc_info=True)
+
+    def stop(self, deadline: float) -> bool:
+        """Останавливает поток, дождавшись финальной записи не дольше deadline секунд. False - если не успел."""
+        if not self.running:
+            return False
+        self._stopping.set()
+        self._wakeup.set()
+        self._thread.join(deadline)
+        if self._thread.is_alive():
+            logger.warning(f"Write-behind persister did not finish flushing within {deadline}s.")
+            return False
+        logger.info("Write-behind persister stopped, all changes flushed.")
+        return True
+
+
+MIGRATION_BATCH_SIZE = 1000
+
+def migrate_json_to_sqlite(source: JsonStorage, target: SqliteStorage) -> int:
+    """Переносит данные из JSON-файлов в SQLite. Исходные файлы не изменяются."""
+    knowledge = source.load_knowledge()
+    if knowledge:
+        target.save_knowledge(knowledge)
+    migrated = 0
+    batch: Dict[int, dict] = {}
+    for user_id, record in source.load_users():
+        batch[user_id] = record
+        if len(batch) >= MIGRATION_BATCH_SIZE:
+            target.save_users(batch)
+            migrated += len(batch)
+            batch = {}
+    if batch:
+        target.save_users(batch)
+        migrated += len(batch)
+    logger.info(f"Migrated knowledge and {migrated} user records from JSON into {target.path}.")
+    return migrated
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Хранилище данных бота")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    migrate_parser = subparsers.add_parser("migrate", help="перенести learned_knowledge.json и user_data/ в SQLite")
+    migrate_parser.add_argument("--db", default=DATABASE_FILE)
+    args = parser.parse_args()
+    if args.command == "migrate":
+        db = SqliteStorage(args.db)
+        count = migrate_json_to_sqlite(JsonStorage(), db)
+        db.close()
+        print(f"Migrated {count} users into {args.db}. Set STORAGE_BACKEND=sqlite to use it.")
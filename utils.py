@@ -1,13 +1,18 @@
 # utils.py
+import hashlib
+import math
 import os
 import re
 import time
 import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from io import BytesIO
-from functools import lru_cache
-from typing import Optional
+from collections import OrderedDict, deque
+from typing import AsyncIterator, Dict, List, Optional, Tuple
 import json
 import google.generativeai as genai
+from google.api_core import exceptions as google_exceptions
 import speech_recognition as sr
 from PIL import Image
 from pydub import AudioSegment
@@ -16,25 +21,110 @@ import random
 from transformers import pipeline
 
 from config import (logger, GEMINI_API_KEY, DEFAULT_STYLE, BOT_NAME,
-                    CONTEXT_CHECK_PROMPT, ASSISTANT_ROLE, settings)
-from state import chat_history, user_info_db, group_preferences, group_user_style_prompts, user_preferred_name
+                    CONTEXT_CHECK_PROMPT, CONTEXT_BATCH_CHECK_PROMPT, SUMMARY_PROMPT, ASSISTANT_ROLE,
+                    LLM_CACHE_FILE, settings)
+import metrics
+from response_cache import ResponseCache
+from state import (chat_history, chat_summaries, summary_candidates, user_info_db, group_preferences,
+                   group_user_style_prompts, user_preferred_name, mark_dirty, rebase_history)
+
+GEMINI_MODEL_NAME = 'gemini-2.0-flash'
 
 try:
     genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.0-flash')
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
     logger.info("Gemini AI model initialized successfully in utils.")
 except Exception as e:
     logger.critical(f"Failed to configure Gemini AI in utils: {e}")
     model = None
 
+NER_MODEL_NAME = "Data-Lab/rubert-base-cased-conversational_ner-v3"
+SENTIMENT_MODEL_NAME = "blanchefort/rubert-base-cased-sentiment"
+
 _ner_pipeline = None
 _sentiment_pipeline = None
+_embedding_pipeline = None
+
+def _load_onnx_pipeline(task: str, model_name: str):
+    """Пайплайн HF поверх ONNX Runtime с тем же форматом вывода, что и у пайплайна PyTorch.
+
+    Модель экспортируется в ONNX и динамически квантизуется в int8 один раз, результат кэшируется в ONNX_CACHE_DIR.
+    """
+    import platform
+    from optimum.onnxruntime import (ORTModelForSequenceClassification, ORTModelForTokenClassification,
+                                     ORTQuantizer)
+    from optimum.onnxruntime.configuration import AutoQuantizationConfig
+    from transformers import AutoTokenizer
+
+    model_cls = ORTModelForTokenClassification if task == "ner" else ORTModelForSequenceClassification
+    export_dir = os.path.join(settings.ONNX_CACHE_DIR, model_name.replace("/", "__"))
+    quantized_dir = os.path.join(export_dir, "int8")
+    quantized_file = "model_quantized.onnx"
+
+    if not os.path.exists(os.path.join(quantized_dir, quantized_file)):
+        logger.info(f"Exporting {model_name} to ONNX with int8 dynamic quantization into {quantized_dir}...")
+        ort_model = model_cls.from_pretrained(model_name, export=True)
+        ort_model.save_pretrained(export_dir)
+        if platform.machine().lower() in ("arm64", "aarch64"):
+            quantization_config = AutoQuantizationConfig.arm64(is_static=False, per_channel=False)
+        else:
+            quantization_config = AutoQuantizationConfig.avx2(is_static=False, per_channel=False)
+        ORTQuantizer.from_pretrained(ort_model).quantize(save_dir=quantized_dir, quantization_config=quantization_config)
+        ort_model.config.save_pretrained(quantized_dir)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(quantized_dir)
+
+    import onnxruntime
+    session_options = onnxruntime.SessionOptions()
+    session_options.intra_op_num_threads = inference_thread_count()
+    session_options.inter_op_num_threads = settings.TORCH_INTEROP_THREADS
+    model = model_cls.from_pretrained(quantized_dir, file_name=quantized_file, session_options=session_options)
+    tokenizer = AutoTokenizer.from_pretrained(quantized_dir)
+    return pipeline(task, model=model, tokenizer=tokenizer)
+
+def _local_model_dir(task: str, model_name: str) -> str:
+    """Путь к копии модели в MODEL_CACHE_DIR в формате safetensors; при первом вызове модель сохраняется туда.
+
+    Из локальной копии модель быстро загружается без обращения к хабу. Веса при этом копируются в обычную память
+    процесса, а не остаются отображением файла: независимо запущенные процессы держат каждый свою копию, делятся ими
+    только воркеры launcher.py (fork + copy-on-write). Если кэш отключен или сохранить модель не удалось,
+    возвращается исходное имя модели.
+    """
+    if not settings.MODEL_CACHE_DIR:
+        return model_name
+    local_dir = os.path.join(settings.MODEL_CACHE_DIR, model_name.replace("/", "__"))
+    if any(os.path.exists(os.path.join(local_dir, f)) for f in ("model.safetensors", "model.safetensors.index.json")):
+        return local_dir
+    try:
+        from transformers import (AutoModel, AutoModelForSequenceClassification, AutoModelForTokenClassification,
+                                  AutoTokenizer)
+        model_cls = {"ner": AutoModelForTokenClassification,
+                     "sentiment-analysis": AutoModelForSequenceClassification}.get(task, AutoModel)
+        logger.info(f"Saving {model_name} as safetensors into {local_dir}...")
+        model_cls.from_pretrained(model_name).save_pretrained(local_dir, safe_serialization=True)
+        AutoTokenizer.from_pretrained(model_name).save_pretrained(local_dir)
+        return local_dir
+    except Exception as e:
+        logger.error(f"Error caching {model_name} as safetensors, loading from the hub cache: {e}", exc_info=True)
+        return model_name
+
+def _load_pipeline(task: str, model_name: str, backend: Optional[str] = None):
+    backend = backend or settings.INFERENCE_BACKEND
+    if backend == "onnx":
+        try:
+            return _load_onnx_pipeline(task, model_name)
+        except ImportError:
+            logger.error("INFERENCE_BACKEND=onnx requires optimum[onnxruntime]; falling back to PyTorch.")
+        except Exception as e:
+            logger.error(f"Error loading ONNX pipeline for {model_name}, falling back to PyTorch: {e}", exc_info=True)
+    model_path = _local_model_dir(task, model_name)
+    model_kwargs = {"use_safetensors": True} if model_path != model_name else {}
+    return pipeline(task, model=model_path, tokenizer=model_path, model_kwargs=model_kwargs)
 
 def get_ner_pipeline():
     global _ner_pipeline
     if _ner_pipeline is None:
         try:
-            _ner_pipeline = pipeline("ner", model="Data-Lab/rubert-base-cased-conversational_ner-v3", tokenizer="Data-Lab/rubert-base-cased-conversational_ner-v3")
+            _ner_pipeline = _load_pipeline("ner", NER_MODEL_NAME)
             logger.info("RuBERT NER pipeline initialized.")
         except Exception as e:
             logger.error(f"Error initializing RuBERT NER pipeline: {e}", exc_info=True)
@@ -45,47 +135,571 @@ def get_sentiment_pipeline():
     global _sentiment_pipeline
     if _sentiment_pipeline is None:
         try:
-            _sentiment_pipeline = pipeline("sentiment-analysis", model="blanchefort/rubert-base-cased-sentiment")
+            _sentiment_pipeline = _load_pipeline("sentiment-analysis", SENTIMENT_MODEL_NAME)
             logger.info("RuBERT Sentiment Analysis pipeline initialized.")
         except Exception as e:
             logger.error(f"Error initializing RuBERT Sentiment Analysis pipeline: {e}", exc_info=True)
             _sentiment_pipeline = None
     return _sentiment_pipeline
 
+def get_embedding_pipeline():
+    global _embedding_pipeline
+    if _embedding_pipeline is None:
+        try:
+            _embedding_pipeline = _load_pipeline("feature-extraction", settings.EMBEDDING_MODEL, backend="torch")
+            logger.info(f"Sentence embedding pipeline initialized ({settings.EMBEDDING_MODEL}).")
+        except Exception as e:
+            logger.error(f"Error initializing sentence embedding pipeline: {e}", exc_info=True)
+            _embedding_pipeline = None
+    return _embedding_pipeline
+
+class MicroBatcher:
+    """Собирает элементы от одновременных вызывающих за короткое окно и обрабатывает их одним пакетом.
+
+    Пакет отправляется, когда набралось max_batch_size элементов или прошло max_wait секунд
+    с первого элемента. Подклассы реализуют _process_batch, возвращающий результаты в том же порядке.
+    """
+    name = "batch"
+    default_result = None # Результат для всех элементов пакета, если обработка упала
+
+    def __init__(self, max_wait: float, max_batch_size: int):
+        self.max_wait = max_wait
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[object, asyncio.Future]] = []
+        self._flush_handle: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_wait > 0 and self.max_batch_size > 1
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((item, future))
+        if len(self._pending) >= self.max_batch_size:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.ensure_future(self._run_batch(batch))
+
+    async def _run_batch(self, batch: List[Tuple[object, asyncio.Future]]):
+        items = [item for item, _ in batch]
+        try:
+            results = await self._process_batch(items)
+        except Exception as e:
+            logger.error(f"Error while processing {self.name} batch of {len(items)}: {e}", exc_info=True)
+            results = [self.default_result] * len(items)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _process_batch(self, items: list) -> list:
+        raise NotImplementedError
+
+def batch_window(window_ms: int) -> float:
+    """Окно пакетирования в секундах. Если обновления обрабатываются по одному, пакеты не набираются и окно только добавляет задержку."""
+    return window_ms / 1000 if settings.CONCURRENT_UPDATES > 1 else 0
+
+_inference_executor: Optional[ThreadPoolExecutor] = None
+_inference_pending = 0
+# Один вызов на пайплайн одновременно: быстрые токенайзеры HF не потокобезопасны, а ленивая загрузка не должна идти дважды
+_pipeline_locks = {"ner": threading.Lock(), "sentiment": threading.Lock(), "embedding": threading.Lock()}
+
+_torch_interop_configured = False
+_torch_config_lock = threading.Lock()
+
+def parse_cpu_list(spec: str) -> set:
+    """Разбирает список ядер вида "0-3,6" в множество номеров."""
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            first, last = part.split("-", 1)
+            cpus.update(range(int(first), int(last) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+def inference_thread_count() -> int:
+    """Число intra-op потоков на один вызов модели."""
+    if settings.TORCH_INTRA_OP_THREADS > 0:
+        return settings.TORCH_INTRA_OP_THREADS
+    affinity = parse_cpu_list(settings.INFERENCE_CPU_AFFINITY)
+    available = len(affinity) if affinity else (os.cpu_count() or 1) - settings.INFERENCE_RESERVED_CPUS
+    return max(1, available // max(1, settings.INFERENCE_WORKERS))
+
+def _init_inference_worker():
+    """Инициализатор потоков пула инференса: привязка к ядрам и лимиты потоков torch."""
+    global _torch_interop_configured
+    cpus = parse_cpu_list(settings.INFERENCE_CPU_AFFINITY)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        try:
+            # В Linux 0 - текущий поток; потоки OpenMP/ONNX Runtime, созданные из него, наследуют маску
+            os.sched_setaffinity(0, cpus)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to set inference CPU affinity {settings.INFERENCE_CPU_AFFINITY}: {e}")
+    try:
+        import torch
+    except ImportError:
+        return
+    torch.set_num_threads(inference_thread_count())
+    with _torch_config_lock:
+        if not _torch_interop_configured:
+            _torch_interop_configured = True
+            try:
+                torch.set_num_interop_threads(settings.TORCH_INTEROP_THREADS)
+            except RuntimeError as e: # Задается только до первой параллельной работы torch в процессе
+                logger.warning(f"Failed to set torch inter-op threads: {e}")
+
+def _get_inference_executor() -> ThreadPoolExecutor:
+    global _inference_executor
+    if _inference_executor is None:
+        _inference_executor = ThreadPoolExecutor(max_workers=settings.INFERENCE_WORKERS, thread_name_prefix="inference",
+                                                 initializer=_init_inference_worker)
+        metrics.set_gauge("inference.intra_op_threads", inference_thread_count())
+        logger.info(f"Inference pool: {settings.INFERENCE_WORKERS} workers x {inference_thread_count()} intra-op threads, "
+                    f"CPU affinity: {settings.INFERENCE_CPU_AFFINITY or 'none'}.")
+    return _inference_executor
+
+async def run_inference(name: str, func, *args):
+    """Выполняет блокирующий вызов модели в пуле инференса.
+
+    Возвращает None, если очередь переполнена или вызов завершился ошибкой.
+    """
+    global _inference_pending
+    if _inference_pending >= settings.INFERENCE_MAX_QUEUE:
+        metrics.inc(f"inference.{name}.rejected")
+        logger.warning(f"Inference queue is full ({_inference_pending}), skipping {name}.")
+        return None
+    _inference_pending += 1
+    metrics.set_gauge("inference.queue_depth", _inference_pending)
+    start = time.monotonic()
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_inference_executor(), func, *args)
+    except Exception as e:
+        metrics.inc(f"inference.{name}.errors")
+        logger.error(f"Error during {name} inference: {e}", exc_info=True)
+        return None
+    finally:
+        _inference_pending -= 1
+        metrics.set_gauge("inference.queue_depth", _inference_pending)
+        metrics.observe(f"inference.{name}.latency", time.monotonic() - start)
+
+def _run_ner_batch(texts: List[str]):
+    with _pipeline_locks["ner"]:
+        ner_model = get_ner_pipeline()
+        return ner_model(texts, batch_size=len(texts)) if ner_model else None
+
+def _run_sentiment_batch(texts: List[str]):
+    with _pipeline_locks["sentiment"]:
+        sentiment_model = get_sentiment_pipeline()
+        return sentiment_model(texts, batch_size=len(texts)) if sentiment_model else None
+
+def _normalized_text_hash(text: str) -> str:
+    return hashlib.sha1(" ".join(text.lower().split()).encode("utf-8")).hexdigest()
+
+class InferenceBatcher(MicroBatcher):
+    """Динамический батчинг для пайплайнов HF: тексты от одновременных обработчиков идут одним дополненным батчем.
+
+    Перед батчингом стоит LRU-кэш результатов по хэшу нормализованного текста; пустые тексты не обрабатываются.
+    """
+    def __init__(self, name: str, batch_func, max_wait: float, max_batch_size: int, cache_size: int = 0):
+        super().__init__(max_wait, max_batch_size)
+        self.name = name
+        self.batch_func = batch_func
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[str, object]" = OrderedDict()
+        metrics.register_collector(lambda: {f"inference.{name}.cache.hit_rate": metrics.ratio(
+            f"inference.{name}.cache.hits", (f"inference.{name}.cache.hits", f"inference.{name}.cache.misses"))})
+
+    async def infer(self, text: str):
+        if not text or not text.strip():
+            metrics.inc(f"inference.{self.name}.skipped_empty")
+            return None
+        key = _normalized_text_hash(text)
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            metrics.inc(f"inference.{self.name}.cache.hits")
+            return self._cache[key]
+        metrics.inc(f"inference.{self.name}.cache.misses")
+
+        if not self.enabled:
+            results = await run_inference(self.name, self.batch_func, [text])
+            result = results[0] if results else None
+        else:
+            result = await self.submit(text)
+
+        if result is not None and self.cache_size > 0:
+            self._cache[key] = result
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return result
+
+    async def _process_batch(self, texts: List[str]) -> list:
+        metrics.observe(f"inference.{self.name}.batch_size", len(texts))
+        results = await run_inference(self.name, self.batch_func, texts)
+        return results if results else [None] * len(texts)
+
+ner_batcher = InferenceBatcher("ner", _run_ner_batch, batch_window(settings.INFERENCE_BATCH_MAX_WAIT_MS),
+                               settings.INFERENCE_BATCH_MAX_SIZE, settings.INFERENCE_CACHE_SIZE)
+sentiment_batcher = InferenceBatcher("sentiment", _run_sentiment_batch, batch_window(settings.INFERENCE_BATCH_MAX_WAIT_MS),
+                                     settings.INFERENCE_BATCH_MAX_SIZE, settings.INFERENCE_CACHE_SIZE)
+
+WARMUP_TEXT = "Привет! Меня зовут Маша, я живу в Ростове Великом."
+
+ml_pipelines_ready = False
+_ml_warmup_task: Optional[asyncio.Task] = None
+
+def _warm_up_pipelines():
+    """Загружает модели и прогоняет пробный текст (блокирующий вызов, выполняется в пуле инференса)."""
+    _run_ner_batch([WARMUP_TEXT])
+    _run_sentiment_batch([WARMUP_TEXT])
+    if settings.CONTEXT_EMBEDDINGS_ENABLED:
+        embedding_similarity(WARMUP_TEXT, WARMUP_TEXT)
+
+def preload_ml_pipelines():
+    """Загружает модели без прогона текста: launcher.py вызывает это до fork, пока пулы потоков torch еще не созданы."""
+    get_ner_pipeline()
+    get_sentiment_pipeline()
+    if settings.CONTEXT_EMBEDDINGS_ENABLED:
+        get_embedding_pipeline()
+
+async def warm_up_ml_pipelines():
+    """Фоновый прогрев локальных моделей. Пока он не завершен, обработчики пропускают обогащение, а не ждут загрузки."""
+    global ml_pipelines_ready
+    logger.info("ML pipelines warm-up started.")
+    metrics.set_gauge("inference.warmup.ready", 0)
+    start = time.monotonic()
+    try:
+        await asyncio.get_running_loop().run_in_executor(_get_inference_executor(), _warm_up_pipelines)
+    except Exception as e:
+        metrics.inc("inference.warmup.errors")
+        logger.error(f"ML pipelines warm-up failed: {e}", exc_info=True)
+        return
+    duration = time.monotonic() - start
+    metrics.observe("inference.warmup.duration", duration)
+    if _ner_pipeline is None or _sentiment_pipeline is None:
+        logger.warning(f"ML pipelines warm-up finished in {duration:.2f}s, but some pipelines failed to load (NER: {_ner_pipeline is not None}, sentiment: {_sentiment_pipeline is not None}).")
+    else:
+        logger.info(f"ML pipelines warmed up in {duration:.2f}s.")
+    ml_pipelines_ready = True
+    metrics.set_gauge("inference.warmup.ready", 1)
+
+def ensure_ml_warm_up():
+    """Запускает прогрев моделей в фоне, если он еще не запущен."""
+    global _ml_warmup_task
+    if _ml_warmup_task is None:
+        _ml_warmup_task = asyncio.ensure_future(warm_up_ml_pipelines())
+
+CYRILLIC_RE = re.compile(r"[а-яё]", re.IGNORECASE)
+
+def should_enrich(text: Optional[str]) -> bool:
+    """Дешевая проверка, стоит ли прогонять текст через NER и тональность.
+
+    Пропускаются пустые и слишком короткие тексты, сообщения только из эмодзи/символов
+    и тексты без кириллицы (модели обучены на русском).
+    """
+    if not text:
+        return False
+    stripped = text.strip()
+    if len(stripped) < settings.ENRICH_MIN_CHARS:
+        return False
+    if not any(ch.isalpha() for ch in stripped):
+        return False
+    return bool(CYRILLIC_RE.search(stripped))
+
+async def analyze_text(text: str):
+    """Извлекает сущности и тональность текста в пуле инференса. Возвращает (entities, sentiment).
+
+    Для тривиальных текстов (см. should_enrich) и пока модели не прогреты возвращает (None, None).
+    """
+    if not should_enrich(text):
+        metrics.inc("inference.gated")
+        return None, None
+    if not ml_pipelines_ready:
+        ensure_ml_warm_up()
+        metrics.inc("inference.skipped_not_ready")
+        return None, None
+    entities, sentiment = await asyncio.gather(ner_batcher.infer(text), sentiment_batcher.infer(text))
+    return entities, sentiment
+
+def _cosine_similarity(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+def embedding_similarity(text_a: str, text_b: str) -> Optional[float]:
+    """Косинусная близость двух текстов по CLS-эмбеддингам (блокирующий вызов, выполняется в пуле инференса)."""
+    with _pipeline_locks["embedding"]:
+        embedder = get_embedding_pipeline()
+        if not embedder:
+            return None
+        outputs = embedder([text_a, text_b], truncation=True)
+    return _cosine_similarity(outputs[0][0][0], outputs[1][0][0])
+
+TOKEN_RE = re.compile(r"\w+|[^\w\s]")
+
+def estimate_tokens(text: str) -> int:
+    """Локальная оценка числа токенов: знак препинания - 1 токен, слово - примерно 1 токен на 4 символа."""
+    return sum((len(token) + 3) // 4 for token in TOKEN_RE.findall(text))
+
+def aggregate_entities(entities, min_score: Optional[float] = None) -> List[Tuple[str, str]]:
+    """Склеивает подтокены NER (B-/I- теги и "##"-части слов) в целые сущности и отбрасывает неуверенные.
+
+    Возвращает список (тип, текст) без повторов, в порядке появления.
+    """
+    min_score = settings.ENTITY_MIN_SCORE if min_score is None else min_score
+    merged = [] # [тип, текст, сумма score, число токенов, конец в исходном тексте]
+    for token in entities or []:
+        word = token.get("word", "")
+        score = float(token.get("score", 0.0))
+        end = token.get("end")
+        if "entity_group" in token: # пайплайн уже агрегировал сущности
+            merged.append([token["entity_group"], word, score, 1, end])
+            continue
+        tag = token.get("entity", "O")
+        if tag == "O":
+            continue
+        prefix, _, label = tag.rpartition("-")
+        current = merged[-1] if merged else None
+        if current and word.startswith("##"):
+            current[1] += word[2:]
+        elif current and prefix == "I" and current[0] == label:
+            start = token.get("start")
+            current[1] += word if start is not None and start == current[4] else f" {word}"
+        else:
+            merged.append([label, word, score, 1, end])
+            continue
+        current[2] += score
+        current[3] += 1
+        current[4] = end
+
+    result = []
+    for label, text, score_sum, count, _ in merged:
+        entity = (label, text.strip())
+        if score_sum / count >= min_score and entity[1] and entity not in result:
+            result.append(entity)
+    return result
+
+def format_annotations(entities=None, sentiment=None) -> str:
+    """Компактная строка аннотаций для промпта, например "PER: Петя; LOC: Москва | sentiment: positive"."""
+    parts = []
+    grouped: Dict[str, List[str]] = {}
+    for label, text in aggregate_entities(entities):
+        grouped.setdefault(label, []).append(text)
+    if grouped:
+        parts.append("; ".join(f"{label}: {', '.join(texts)}" for label, texts in grouped.items()))
+    if sentiment and sentiment.get("label"):
+        parts.append(f"sentiment: {str(sentiment['label']).lower()}")
+    return " | ".join(parts)
+
 class PromptBuilder:
-    def __init__(self, bot_name, default_style):
+    def __init__(self, bot_name, default_style, token_budget: Optional[int] = None):
         self.bot_name = bot_name
         self.default_style = default_style
+        self.token_budget = token_budget or settings.PROMPT_TOKEN_BUDGET
+
+    def build_prompt(self, history, user_name, prompt_text, metadata=None, entities=None, sentiment=None, summary=None):
+        """Собирает промпт в пределах бюджета токенов.
 
-    def build_prompt(self, history_str, user_name, prompt_text, system_message_base, topic_context="", entities=None, sentiment=None):
-        prompt = f"{system_message_base} {topic_context}\n\nИстория диалога:\n{history_str}\n\n{user_name}: {prompt_text}\n{self.bot_name}:"
-        if entities:
-            prompt += f"\n\nИзвлеченные сущности: {entities}"
-        if sentiment:
-            prompt += f"\n\nТональность сообщения: {sentiment}"
+        Стиль и тема берутся из метаданных чата (state.chat_metadata) и выводятся один раз в начале. Они, краткое
+        содержание и текущее сообщение входят всегда, история заполняет остаток бюджета начиная с новых реплик.
+        """
+        metadata = metadata or {}
+        header = f"{metadata.get('style') or self.default_style} {metadata.get('topic', '')}\n\n"
+        if summary:
+            header += f"Краткое содержание предыдущего разговора: {summary}\n\n"
+        header += "История диалога:\n"
+        footer = f"\n\n{user_name}: {prompt_text}\n{self.bot_name}:"
+        annotations = format_annotations(entities, sentiment)
+        if annotations:
+            footer += f"\n\nАннотации сообщения: {annotations}"
+
+        remaining = self.token_budget - estimate_tokens(header) - estimate_tokens(footer)
+        history_entries = list(history)
+        selected = []
+        for entry in reversed(history_entries):
+            cost = estimate_tokens(entry) + 1 # +1 за перевод строки
+            if cost > remaining:
+                break
+            selected.append(entry)
+            remaining -= cost
+        if len(selected) < len(history_entries):
+            logger.debug(f"Prompt budget {self.token_budget}: kept {len(selected)} of {len(history_entries)} history entries.")
+
+        prompt = header + "\n".join(reversed(selected)) + footer
+        metrics.observe("prompt.estimated_tokens", self.token_budget - remaining)
         return prompt
 
-@lru_cache(maxsize=128)
-def generate_content_sync(prompt: str) -> str:
-    if not model:
-        logger.error("Gemini model not initialized. Cannot generate content.")
-        return "[Ошибка: Модель AI не инициализирована]"
+_gemini_semaphore: Optional[asyncio.Semaphore] = None
+response_cache = ResponseCache(settings.LLM_CACHE_MAX_BYTES, settings.LLM_CACHE_TTL,
+                               path=LLM_CACHE_FILE, namespace=GEMINI_MODEL_NAME, log=logger)
+metrics.register_collector(lambda: {f"llm.cache.{k}": v for k, v in response_cache.stats().items()})
+_inflight_requests: Dict[str, asyncio.Future] = {}
+
+def _get_gemini_semaphore() -> asyncio.Semaphore:
+    """Общий семафор, ограничивающий число одновременных запросов к Gemini."""
+    global _gemini_semaphore
+    if _gemini_semaphore is None:
+        _gemini_semaphore = asyncio.Semaphore(settings.GEMINI_MAX_CONCURRENCY)
+    return _gemini_semaphore
+
+def _extract_response_text(response) -> str:
+    if hasattr(response, 'text') and response.text:
+        logger.info(f"Received response from Gemini (first 100 chars): {response.text[:100]}...")
+        return response.text
+    elif response.prompt_feedback.block_reason:
+        logger.warning(f"Gemini response blocked. Reason: {response.prompt_feedback.block_reason}")
+        return f"[Ответ заблокирован: {response.prompt_feedback.block_reason}]"
+    else:
+        logger.warning("Gemini response was empty or lacked text attribute.")
+        return "[Пустой ответ от Gemini]"
+
+# Ошибки, при которых запрос имеет смысл повторить: 429, 5xx, таймауты и обрывы соединения
+TRANSIENT_GEMINI_ERRORS = (google_exceptions.TooManyRequests, google_exceptions.ServerError,
+                           asyncio.TimeoutError, ConnectionError)
+HEDGING_MIN_SAMPLES = 20
+
+_attempt_latencies = deque(maxlen=200) # Латентности последних успешных попыток, для p95
 
+def _latency_p95() -> Optional[float]:
+    if len(_attempt_latencies) < HEDGING_MIN_SAMPLES:
+        return None
+    samples = sorted(_attempt_latencies)
+    return samples[int(0.95 * (len(samples) - 1))]
+
+async def _timed_attempt(make_call):
+    start = time.monotonic()
+    try:
+        async with _get_gemini_semaphore():
+            result = await make_call()
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        metrics.inc("llm.attempt.errors")
+        metrics.observe("llm.attempt.failed_latency", time.monotonic() - start)
+        raise
+    latency = time.monotonic() - start
+    _attempt_latencies.append(latency)
+    metrics.observe("llm.attempt.latency", latency)
+    return result
+
+async def _hedged_attempt(make_call, hedge: bool):
+    """Одна попытка; если она дольше p95, параллельно запускается вторая и берется первый успешный ответ."""
+    hedge_delay = _latency_p95() if hedge else None
+    first = asyncio.ensure_future(_timed_attempt(make_call))
+    tasks = [first]
+    try:
+        if hedge_delay is None:
+            return await first
+
+        done, _ = await asyncio.wait({first}, timeout=hedge_delay)
+        if done:
+            return first.result()
+        metrics.inc("llm.hedged_requests")
+        logger.debug(f"Gemini call slower than p95 ({hedge_delay:.2f}s), sending hedged request.")
+        tasks.append(asyncio.ensure_future(_timed_attempt(make_call)))
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # В том числе при отмене по общему дедлайну: незавершенные попытки не должны держать слот семафора
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+
+async def _call_with_policy(make_call, hedge: bool = False):
+    """Выполняет вызов Gemini с общим дедлайном, повторами с экспоненциальной задержкой (full jitter) и хеджированием."""
+    deadline = time.monotonic() + settings.GEMINI_DEADLINE
+    attempt = 0
+    while True:
+        attempt += 1
+        try:
+            return await asyncio.wait_for(_hedged_attempt(make_call, hedge), timeout=deadline - time.monotonic())
+        except TRANSIENT_GEMINI_ERRORS as e:
+            backoff = random.uniform(0, min(settings.GEMINI_RETRY_MAX_DELAY, settings.GEMINI_RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+            if attempt > settings.GEMINI_MAX_RETRIES or time.monotonic() + backoff >= deadline:
+                metrics.inc("llm.retries_exhausted")
+                raise
+            metrics.inc("llm.retries")
+            logger.warning(f"Transient Gemini error ({type(e).__name__}: {e}), retry {attempt}/{settings.GEMINI_MAX_RETRIES} in {backoff:.2f}s")
+            await asyncio.sleep(backoff)
+
+async def _call_gemini(prompt: str) -> str:
     logger.info(f"Sending prompt to Gemini (first 100 chars): {prompt[:100]}...")
     try:
-        response = model.generate_content(prompt)
-        if hasattr(response, 'text') and response.text:
-            logger.info(f"Received response from Gemini (first 100 chars): {response.text[:100]}...")
-            return response.text
-        elif response.prompt_feedback.block_reason:
-             logger.warning(f"Gemini response blocked. Reason: {response.prompt_feedback.block_reason}")
-             return f"[Ответ заблокирован: {response.prompt_feedback.block_reason}]"
-        else:
-            logger.warning("Gemini response was empty or lacked text attribute.")
-            return "[Пустой ответ от Gemini]"
+        response = await _call_with_policy(lambda: model.generate_content_async(prompt), hedge=settings.GEMINI_HEDGING)
+        response_text = _extract_response_text(response)
     except Exception as e:
         logger.error(f"Gemini content generation error: {e}", exc_info=True)
-        return f"[Произошла ошибка при генерации ответа: {type(e).__name__}]"
+        response_text = f"[Произошла ошибка при генерации ответа: {type(e).__name__}]"
+
+    response_cache.put(prompt, response_text) # Ошибки и блокировки ("[...]") не кэшируются
+    return response_text
+
+async def generate_content_async(prompt: str) -> str:
+    """Генерирует ответ через нативный асинхронный клиент Gemini, не занимая потоки.
+
+    Одинаковые промпты, запрошенные одновременно, ждут один общий запрос (single-flight).
+    """
+    if not model:
+        logger.error("Gemini model not initialized. Cannot generate content.")
+        return "[Ошибка: Модель AI не инициализирована]"
+
+    cached = response_cache.get(prompt)
+    if cached is not None:
+        metrics.inc("llm.singleflight.hits")
+        return cached
+
+    task = _inflight_requests.get(prompt)
+    if task is not None:
+        metrics.inc("llm.singleflight.joins")
+    else:
+        metrics.inc("llm.singleflight.misses")
+        # Запрос выполняется отдельной задачей: отмена одного из ожидающих не отменяет его для остальных
+        task = asyncio.ensure_future(_call_gemini(prompt))
+        _inflight_requests[prompt] = task
+        task.add_done_callback(lambda _: _inflight_requests.pop(prompt, None))
+    return await asyncio.shield(task)
+
+class ResponseBlockedError(Exception):
+    """Gemini заблокировал ответ во время потоковой генерации."""
+
+async def stream_content_async(prompt: str) -> AsyncIterator[str]:
+    """Отдает ответ Gemini по частям по мере генерации. Исключения пробрасываются вызывающему.
+
+    Блокировка ответа (в том числе после уже отданных частей) - исключение ResponseBlockedError, а не текст в потоке.
+    """
+    if not model:
+        logger.error("Gemini model not initialized. Cannot stream content.")
+        yield "[Ошибка: Модель AI не инициализирована]"
+        return
+
+    logger.info(f"Streaming prompt to Gemini (first 100 chars): {prompt[:100]}...")
+    async with _get_gemini_semaphore():
+        response = await model.generate_content_async(prompt, stream=True,
+                                                      request_options={"timeout": settings.GEMINI_DEADLINE})
+        async for chunk in response:
+            if chunk.parts:
+                yield chunk.text
+            elif chunk.prompt_feedback and chunk.prompt_feedback.block_reason:
+                raise ResponseBlockedError(chunk.prompt_feedback.block_reason)
 
 async def generate_vision_content_async(contents: list) -> str:
     if not model:
@@ -94,7 +708,8 @@ async def generate_vision_content_async(contents: list) -> str:
 
     logger.info("Sending image/prompt to Gemini Vision...")
     try:
-        response = await asyncio.to_thread(model.generate_content, contents)
+        # Без хеджирования: дублировать загрузку изображения слишком дорого
+        response = await _call_with_policy(lambda: model.generate_content_async(contents))
         response_text = response.text if hasattr(response, 'text') else ''
         if not response_text and hasattr(response, 'prompt_feedback') and response.prompt_feedback.block_reason:
             response_text = f"[Ответ на изображение заблокирован: {response.prompt_feedback.block_reason}]"
@@ -106,6 +721,17 @@ async def generate_vision_content_async(contents: list) -> str:
         logger.error(f"Gemini Vision API error: {e}", exc_info=True)
         return "[Ошибка при анализе изображения]"
 
+async def warm_up_gemini():
+    """Открывает соединение асинхронного клиента Gemini заранее, чтобы первый ответ не платил за TLS/HTTP2."""
+    if not model:
+        return
+    start = time.monotonic()
+    try:
+        await model.count_tokens_async("ping")
+        logger.info(f"Gemini async client warmed up in {time.monotonic() - start:.2f}s.")
+    except Exception as e:
+        logger.warning(f"Gemini warm-up failed: {e}")
+
 
 def filter_response(response: str) -> str:
     if not response:
@@ -174,6 +800,60 @@ async def _get_effective_style(chat_id: int, user_id: int, user_name: Optional[s
 
     return DEFAULT_STYLE
 
+async def _check_context_single(current_message: str, last_bot_message: str) -> bool:
+    prompt = CONTEXT_CHECK_PROMPT.format(current_message=current_message, last_bot_message=last_bot_message)
+    response_text = await generate_content_async(prompt)
+    logger.debug(f"Context check response: {response_text}")
+    return response_text.strip().lower().startswith("да")
+
+BATCH_ANSWER_RE = re.compile(r"^\W*(\d+)\W+(да|нет)", re.IGNORECASE | re.MULTILINE)
+
+def _parse_batch_answers(response_text: str, count: int) -> Optional[List[bool]]:
+    answers = {}
+    for match in BATCH_ANSWER_RE.finditer(response_text):
+        answers.setdefault(int(match.group(1)), match.group(2).lower() == "да")
+    if set(answers) != set(range(1, count + 1)):
+        return None
+    return [answers[i] for i in range(1, count + 1)]
+
+class ContextCheckBatcher(MicroBatcher):
+    """Собирает проверки контекста из всех чатов за короткое окно и отправляет их одним запросом к Gemini.
+
+    Если ответ на пакет не удалось разобрать, каждая проверка выполняется отдельным запросом.
+    """
+    name = "context"
+    default_result = False
+
+    async def check(self, current_message: str, last_bot_message: str) -> bool:
+        if not self.enabled:
+            return await _check_context_single(current_message, last_bot_message)
+        return await self.submit((current_message, last_bot_message))
+
+    async def _process_batch(self, items: List[Tuple[str, str]]) -> List[bool]:
+        # Одинаковые пары из разных обработчиков проверяем один раз
+        unique_items = list(dict.fromkeys(items))
+        metrics.observe("context.batch.size", len(unique_items))
+        if len(unique_items) == 1:
+            results = [await _check_context_single(*unique_items[0])]
+        else:
+            items_text = "\n\n".join(
+                f'{i}. Сообщение пользователя: "{current}"\n   Предыдущее сообщение бота: "{last_bot}"'
+                for i, (current, last_bot) in enumerate(unique_items, start=1)
+            )
+            prompt = CONTEXT_BATCH_CHECK_PROMPT.format(count=len(unique_items), items=items_text)
+            response_text = await generate_content_async(prompt)
+            logger.debug(f"Batched context check response: {response_text}")
+            results = _parse_batch_answers(response_text, len(unique_items))
+            if results is None:
+                logger.warning(f"Could not parse batched context check for {len(unique_items)} items, falling back to single calls.")
+                metrics.inc("context.batch.fallbacks")
+                results = await asyncio.gather(*(_check_context_single(*item) for item in unique_items))
+
+        result_by_item = dict(zip(unique_items, results))
+        return [result_by_item[item] for item in items]
+
+context_check_batcher = ContextCheckBatcher(batch_window(settings.CONTEXT_BATCH_WINDOW_MS), settings.CONTEXT_BATCH_MAX_SIZE)
+
 async def is_context_related(current_message: str, user_id: int, chat_id: int, chat_type: str) -> bool:
     history_key = chat_id if chat_type in ['group', 'supergroup'] else user_id
     history = chat_history.get(history_key)
@@ -187,18 +867,80 @@ async def is_context_related(current_message: str, user_id: int, chat_id: int, c
     if not last_bot_message: return False
     if len(current_message.split()) < 2: return False
 
-    prompt = CONTEXT_CHECK_PROMPT.format(current_message=current_message, last_bot_message=last_bot_message)
     logger.debug(f"Checking context for user {user_id} in chat {chat_id}")
+    if settings.CONTEXT_EMBEDDINGS_ENABLED and ml_pipelines_ready:
+        similarity = await run_inference("embedding", embedding_similarity, current_message, last_bot_message)
+        if similarity is not None:
+            logger.debug(f"Context similarity for user {user_id}: {similarity:.3f}")
+            if similarity >= settings.CONTEXT_SIMILARITY_HIGH:
+                metrics.inc("context.fastpath.related")
+                logger.info(f"Context check result for user {user_id}: True (local, similarity {similarity:.3f})")
+                return True
+            if similarity <= settings.CONTEXT_SIMILARITY_LOW:
+                metrics.inc("context.fastpath.unrelated")
+                logger.info(f"Context check result for user {user_id}: False (local, similarity {similarity:.3f})")
+                return False
+            metrics.inc("context.fastpath.ambiguous")
+
     try:
-        response_text = await asyncio.to_thread(generate_content_sync, prompt)
-        logger.debug(f"Context check response: {response_text}")
-        is_related = response_text.strip().lower().startswith("да")
+        is_related = await context_check_batcher.check(current_message, last_bot_message)
         logger.info(f"Context check result for user {user_id}: {is_related}")
         return is_related
     except Exception as e:
         logger.error(f"Error during context check: {e}", exc_info=True)
         return False
 
+_summary_retry_at: Dict[int, float] = {} # Ключ -> время (monotonic), раньше которого не повторять неудавшееся сжатие
+
+async def summarize_histories_job(context):
+    """Фоновая задача: сжимает старые реплики длинных историй в краткое содержание.
+
+    Запускается JobQueue, поэтому никогда не задерживает ответы пользователям.
+    """
+    if not settings.SUMMARIZATION_ENABLED:
+        summary_candidates.clear()
+        return
+    keys = list(summary_candidates)
+    summary_candidates.clear()
+    for key in keys:
+        history = chat_history.get(key)
+        if not history or len(history) < settings.SUMMARY_TRIGGER_ENTRIES:
+            _summary_retry_at.pop(key, None)
+            continue
+        if time.monotonic() < _summary_retry_at.get(key, 0):
+            summary_candidates.add(key) # Недавно не удалось - попробуем после паузы
+            continue
+        to_summarize = list(history)[:len(history) - settings.SUMMARY_KEEP_RECENT]
+        if not to_summarize:
+            continue
+
+        prompt = SUMMARY_PROMPT.format(previous_summary=chat_summaries.get(key) or "нет", dialogue="\n".join(to_summarize))
+        start = time.monotonic()
+        summary = filter_response(await generate_content_async(prompt))
+        if not summary or summary.startswith("["):
+            logger.warning(f"Summarization failed for key {key}, retrying in {settings.SUMMARY_RETRY_DELAY}s: {(summary or '')[:100]}")
+            metrics.inc("summaries.failed")
+            _summary_retry_at[key] = time.monotonic() + settings.SUMMARY_RETRY_DELAY
+            summary_candidates.add(key)
+            continue
+        _summary_retry_at.pop(key, None)
+        if chat_history.get(key) is not history:
+            continue # История была очищена или заменена, пока шло сжатие
+
+        # Пока шел запрос, часть старых реплик могла вытесниться из deque по maxlen - пропускаем их
+        removed = 0
+        for entry in to_summarize:
+            if not history:
+                break
+            if history[0] == entry:
+                history.popleft()
+                removed += 1
+        chat_summaries[key] = summary
+        rebase_history(key)
+        metrics.inc("summaries.created")
+        metrics.observe("summaries.duration", time.monotonic() - start)
+        logger.info(f"Summarized {removed} history entries for key {key} in {time.monotonic() - start:.2f}s.")
+
 async def update_user_info(update: Update):
     if not update.effective_user: return
 
@@ -216,6 +958,7 @@ async def update_user_info(update: Update):
 
     if user_id not in user_preferred_name:
         user_preferred_name[user_id] = user.first_name
+    mark_dirty(user_id)
 
     logger.debug(f"User info updated for user_id: {user_id}")
 